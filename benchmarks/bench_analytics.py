@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of the hours breakdown over synthetic time entries.
+
+Compares HoursAnalytics, loading and grouping column arrays, with plain
+dictionary loops over the TimeEntry objects, at team by quarter sizes.
+HoursAnalytics uses NumPy when it is installed.
+
+Usage: python benchmarks/bench_analytics.py [entries]
+"""
+__author__ = 'amrodriguez'
+
+import datetime
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from weekly import HoursAnalytics, TimeEntry
+
+TAGS = ['issue', 'achievement', 'help', 'shortterm', 'forecasted']
+
+
+def make_entries(count):
+    rnd = random.Random(count)
+    start = datetime.date.today() - datetime.timedelta(days=91)
+    entries, tags = [], {}
+    for i in xrange(count):
+        entries.append(TimeEntry(i, rnd.randint(1, 2000), rnd.randint(1, 50), None, rnd.randint(1, 20), None,
+                                 rnd.choice([0.25, 0.5, 1.0, 2.0, 4.0]),
+                                 start + datetime.timedelta(days=rnd.randint(0, 90)), u''))
+        tags[i] = set(rnd.sample(TAGS, rnd.randint(0, 2)))
+    return entries, tags
+
+
+def dict_loops(entries, tags):
+    by_issue, by_project, by_tag, by_weekday, by_week = {}, {}, {}, [0.0] * 7, {}
+    for te in entries:
+        by_issue[te.issue_id] = by_issue.get(te.issue_id, 0.0) + te.hours
+        by_project[te.project_id] = by_project.get(te.project_id, 0.0) + te.hours
+        for tag in tags[te.id]:
+            by_tag[tag] = by_tag.get(tag, 0.0) + te.hours
+        by_weekday[te.spent_on.weekday()] += te.hours
+        monday = te.spent_on - datetime.timedelta(days=te.spent_on.weekday())
+        by_week[monday] = by_week.get(monday, 0.0) + te.hours
+    return by_issue, by_project, by_tag, by_weekday, by_week
+
+
+def analytics(entries, tags):
+    result = HoursAnalytics(entries, TAGS, lambda te: tags[te.id])
+    return result.by_issue(), result.by_project(), result.by_tag(), result.by_weekday(), result.by_week()
+
+
+def main():
+    counts = [int(sys.argv[1])] if len(sys.argv) > 1 else [10000, 100000, 500000]
+
+    print '{:>10} {:>12} {:>14} {:>14}'.format('entries', 'dicts (s)', 'analytics (s)', 'group-bys (s)')
+    for count in counts:
+        entries, tags = make_entries(count)
+        loops = min(timeit.repeat(lambda: dict_loops(entries, tags), number=1, repeat=3))
+        total = min(timeit.repeat(lambda: analytics(entries, tags), number=1, repeat=3))
+
+        loaded = HoursAnalytics(entries, TAGS, lambda te: tags[te.id])
+        group_bys = min(timeit.repeat(lambda: (loaded.by_issue(), loaded.by_project(), loaded.by_tag(),
+                                               loaded.by_weekday(), loaded.by_week()), number=1, repeat=3))
+
+        print '{:>10} {:>12.3f} {:>14.3f} {:>14.3f}'.format(count, loops, total, group_bys)
+
+
+if __name__ == '__main__':
+    main()
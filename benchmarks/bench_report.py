@@ -0,0 +1,160 @@
+"""
+End to end benchmark of Weekly.report_week against a local fake Redmine.
+
+Each scenario runs in its own process so its peak memory can be measured.
+It reports wall time, the number of HTTP requests served, peak memory and
+the time spent in each phase. Results are appended to
+benchmarks/results.jsonl; --compare shows the previous result of the same
+scenario next to the new one.
+
+Usage: python benchmarks/bench_report.py [--entries 10,1000,100000]
+       [--latency MS] [--workers N] [--cache] [--label TEXT] [--compare]
+"""
+__author__ = 'amrodriguez'
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_FILE = os.path.join(BENCH_DIR, 'results.jsonl')
+
+sys.path.insert(0, REPO_DIR)
+
+
+def peak_memory_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_scenario(entries, latency, workers, cache):
+    """
+    Generates a report against a fake server in the current process.
+    :return: A dictionary of the metrics measured.
+    """
+    os.chdir(REPO_DIR)
+    import weekly
+    from fake_redmine import TAGS, FakeRedmineServer, SyntheticData
+
+    data = SyntheticData(entries=entries, issues=max(10, entries // 5), users=5)
+    server = FakeRedmineServer(data, latency=latency / 1000.0)
+    server.start()
+
+    workdir = tempfile.mkdtemp(prefix='weekly-bench-')
+    runs = []
+    try:
+        disk_cache = weekly.ResourceCache(os.path.join(workdir, 'weekly.cache')) if cache else None
+        for _ in xrange(2 if cache else 1):
+            server.request_count = 0
+            profiler = weekly.Profiler()
+            started = time.time()
+            report = weekly.Weekly(args=weekly.make_arg_parser().parse_args([]),
+                                   api_key='bench',
+                                   main_project_id=data.main_project_id,
+                                   other_tasks_id=data.other_tasks_id,
+                                   tags=TAGS,
+                                   rm_url=server.url,
+                                   workers=workers,
+                                   disk_cache=disk_cache,
+                                   profiler=profiler)
+            os.chdir(workdir)
+            report.report_week()
+            os.chdir(REPO_DIR)
+            runs.append({'wall_time': time.time() - started,
+                         'requests': server.request_count,
+                         'phases': dict((name, total) for name, (calls, total) in profiler.phases.items())})
+        if disk_cache is not None:
+            disk_cache.close()
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.shutdown()
+
+    return {'runs': runs, 'peak_memory_kb': peak_memory_kb()}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(scenario):
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    previous = None
+    with open(RESULTS_FILE) as f:
+        for line in f:
+            result = json.loads(line)
+            if result['scenario'] == scenario:
+                previous = result
+    return previous
+
+
+def print_result(result, previous):
+    scenario = result['scenario']
+    print 'entries={entries} latency={latency}ms workers={workers} cache={cache}'.format(**scenario)
+    for i, run in enumerate(result['runs']):
+        line = '  run {}: {:.3f}s, {} requests'.format(i + 1, run['wall_time'], run['requests'])
+        if previous and i < len(previous['runs']):
+            before = previous['runs'][i]
+            line += ' (was {:.3f}s, {} requests at {})'.format(before['wall_time'], before['requests'],
+                                                             previous.get('commit') or previous['timestamp'])
+        print line
+        for name, total in sorted(run['phases'].items(), key=lambda item: -item[1]):
+            print '    {:<20} {:>8.3f}s'.format(name, total)
+    if result['peak_memory_kb'] is not None:
+        print '  peak memory: {:.1f} MB'.format(result['peak_memory_kb'] / 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark weekly.py against a local fake Redmine.')
+    parser.add_argument('--entries', default='10,1000,10000',
+                        help='Comma separated numbers of time entries, one scenario each.')
+    parser.add_argument('--latency', type=float, default=0, help='Latency of each request in milliseconds.')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--cache', action='store_true',
+                        help='Use a persistent cache and measure a cold and a warm run.')
+    parser.add_argument('--label', help='Label stored with the results.')
+    parser.add_argument('--compare', action='store_true',
+                        help='Show the previous result of each scenario next to the new one.')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print json.dumps(run_scenario(int(args.entries), args.latency, args.workers, args.cache))
+        return
+
+    for entries in [int(e) for e in args.entries.split(',')]:
+        command = [sys.executable, os.path.abspath(__file__), '--run', '--entries', str(entries),
+                   '--latency', str(args.latency), '--workers', str(args.workers)]
+        if args.cache:
+            command.append('--cache')
+        output = subprocess.check_output(command, env=dict(os.environ))
+
+        scenario = {'entries': entries, 'latency': args.latency, 'workers': args.workers, 'cache': args.cache}
+        result = dict(json.loads(output.splitlines()[-1]),
+                      scenario=scenario,
+                      label=args.label,
+                      commit=git_commit(),
+                      timestamp=datetime.datetime.now().isoformat())
+
+        print_result(result, previous_result(scenario) if args.compare else None)
+
+        with open(RESULTS_FILE, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Start up time benchmark of weekly.py.
+
+Measures, in fresh processes, how long importing the module and printing
+the command line help take, and which of the heavy dependencies got
+imported on the way.
+
+Usage: python benchmarks/bench_startup.py [--repeat N]
+"""
+__author__ = 'amrodriguez'
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+HEAVY_MODULES = ['redmine', 'requests', 'mako']
+
+IMPORT_PROBE = ('import json, sys; import weekly; '
+                'print json.dumps(dict((m, m in sys.modules) for m in {!r}))').format(HEAVY_MODULES)
+
+
+def time_command(command, repeat):
+    """
+    Runs the command repeat times.
+    :return: A tuple (best, average, output) with the wall times in seconds
+             and the output of the last run.
+    """
+    times = []
+    output = None
+    for _ in xrange(repeat):
+        started = time.time()
+        output = subprocess.check_output(command, cwd=REPO_DIR)
+        times.append(time.time() - started)
+    return min(times), sum(times) / len(times), output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the start up time of weekly.py.')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of runs of each command.')
+    args = parser.parse_args()
+
+    commands = [('python (baseline)', [sys.executable, '-c', 'pass']),
+                ('import weekly', [sys.executable, '-c', IMPORT_PROBE]),
+                ('weekly.py --help', [sys.executable, os.path.join(REPO_DIR, 'weekly.py'), '--help'])]
+
+    for name, command in commands:
+        best, average, output = time_command(command, args.repeat)
+        print '{:<20} best {:>7.1f}ms  average {:>7.1f}ms'.format(name, best * 1000, average * 1000)
+        if command[-1] == IMPORT_PROBE:
+            loaded = json.loads(output.splitlines()[-1])
+            print '  imported on start: {}'.format(', '.join(m for m in HEAVY_MODULES if loaded[m]) or 'none')
+
+
+if __name__ == '__main__':
+    main()
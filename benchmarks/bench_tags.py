@@ -0,0 +1,64 @@
+"""
+Micro-benchmark of the tag matcher over synthetic comment corpora.
+
+Compares TagMatcher.parse with the previous approach (a greedy regex run
+once to mine tags and again to strip them) for growing tag vocabularies.
+
+Usage: python benchmarks/bench_tags.py [comments]
+"""
+__author__ = 'amrodriguez'
+
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from weekly import TagMatcher
+
+WORDS = ['fixed', 'review', 'meeting', 'with', 'the', 'team', 'deploy', 'build',
+         'tests', 'customer', 'call', 'docs', 'refactor', 'parser', 'report']
+
+
+def make_corpus(count, vocabulary, tags_per_comment=2):
+    rnd = random.Random(count * 31 + len(vocabulary))
+    corpus = []
+    for _ in xrange(count):
+        words = [rnd.choice(WORDS) for _ in xrange(rnd.randint(4, 12))]
+        for _ in xrange(rnd.randint(0, tags_per_comment)):
+            words.insert(rnd.randint(0, len(words)), '#' + rnd.choice(vocabulary).upper())
+        corpus.append(' '.join(words))
+    return corpus
+
+
+def legacy_parse(known_tags, tag_regex, text):
+    tags = [t.lower() for t in tag_regex.findall(text.lower()) if t.lower() in known_tags]
+    for tag in ['#{}'.format(t) for t in tag_regex.findall(text)]:
+        text = text.replace(tag, '')
+    return text.strip(), tags
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print '{:>10} {:>10} {:>12} {:>12} {:>8}'.format('tags', 'comments', 'legacy (s)', 'matcher (s)', 'speedup')
+    for size in (5, 50, 500):
+        vocabulary = ['tag{}'.format(i) for i in xrange(size)]
+        config_values = ['{0}, {0}alias'.format(t) for t in vocabulary]
+        corpus = make_corpus(count, vocabulary + [t + 'alias' for t in vocabulary])
+
+        known_tags = list(vocabulary)
+        tag_regex = re.compile(r'.*#(\w+)')
+        matcher = TagMatcher(config_values)
+
+        legacy = min(timeit.repeat(lambda: [legacy_parse(known_tags, tag_regex, c) for c in corpus],
+                                   number=1, repeat=3))
+        current = min(timeit.repeat(lambda: [matcher.parse(c) for c in corpus], number=1, repeat=3))
+
+        print '{:>10} {:>10} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(size, count, legacy, current, legacy / current)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Local stand-in for a Redmine server.
+
+Serves synthetic users, groups, projects, issues and time entries through
+the subset of the Redmine REST API used by weekly.py, with an optional
+artificial latency per request, so reports can be measured offline.
+"""
+__author__ = 'amrodriguez'
+
+import BaseHTTPServer
+import datetime
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+REDMINE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 100
+
+WORDS = ['fixed', 'review', 'meeting', 'with', 'the', 'team', 'deploy', 'build',
+         'tests', 'customer', 'call', 'docs', 'refactor', 'parser', 'report']
+TAGS = ['issue', 'achievement', 'help', 'shortterm', 'forecasted']
+
+
+class SyntheticData(object):
+    """
+    Deterministic synthetic Redmine dataset. Time entries are spread over
+    the given number of days ending today and over all the users.
+    """
+
+    def __init__(self, entries=1000, users=5, projects=20, issues=300, days=7, seed=1):
+        rnd = random.Random(seed)
+        today = datetime.date.today()
+        now = datetime.datetime.utcnow().strftime(REDMINE_TIME_FORMAT)
+
+        self.main_project_id = 1
+        self.other_tasks_id = 1
+
+        self.users = [{'id': i, 'login': 'user{}'.format(i), 'firstname': 'User', 'lastname': str(i),
+                       'mail': 'user{}@example.com'.format(i), 'created_on': now}
+                      for i in xrange(1, users + 1)]
+
+        self.projects = []
+        for i in xrange(1, projects + 1):
+            project = {'id': i, 'name': 'Project {}'.format(i), 'identifier': 'project-{}'.format(i),
+                       'description': '', 'created_on': now, 'updated_on': now}
+            if i > 1 and rnd.random() < 0.3:
+                parent = rnd.randint(1, i - 1)
+                project['parent'] = {'id': parent, 'name': 'Project {}'.format(parent)}
+            self.projects.append(project)
+
+        self.issues = []
+        for i in xrange(1, issues + 1):
+            project = rnd.choice(self.projects)
+            done_ratio = rnd.choice([0, 30, 60, 100])
+            self.issues.append({'id': i,
+                                'project': {'id': project['id'], 'name': project['name']},
+                                'tracker': {'id': 1, 'name': 'Task'},
+                                'status': {'id': 5 if done_ratio == 100 else 2,
+                                           'name': 'Done' if done_ratio == 100 else 'In Progress'},
+                                'priority': {'id': 2, 'name': 'Normal'},
+                                'author': {'id': 1, 'name': 'User 1'},
+                                'subject': 'Issue {} {}'.format(i, ' '.join(rnd.sample(WORDS, 3))),
+                                'description': '',
+                                'done_ratio': done_ratio,
+                                'created_on': now,
+                                'updated_on': now})
+
+        self.time_entries = []
+        for i in xrange(1, entries + 1):
+            issue = rnd.choice(self.issues)
+            user = self.users[i % users]
+            words = [rnd.choice(WORDS) for _ in xrange(rnd.randint(3, 10))]
+            if rnd.random() < 0.2:
+                words.append('#' + rnd.choice(TAGS))
+            spent_on = today - datetime.timedelta(days=rnd.randint(0, days - 1))
+            self.time_entries.append({'id': i,
+                                      'project': dict(issue['project']),
+                                      'issue': {'id': issue['id']},
+                                      'user': {'id': user['id'], 'name': 'User {}'.format(user['id'])},
+                                      'activity': {'id': 9, 'name': 'Development'},
+                                      'hours': round(rnd.uniform(0.25, 4), 2),
+                                      'comments': ' '.join(words),
+                                      'spent_on': str(spent_on),
+                                      'created_on': now,
+                                      'updated_on': now})
+
+        self.groups = [{'id': 1000, 'name': 'Team', 'users': [{'id': u['id'], 'name': 'User {}'.format(u['id'])}
+                                                              for u in self.users]}]
+
+
+class FakeRedmineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.record_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urlparse.urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).items())
+        data = self.server.data
+
+        match = re.match(r'^/(\w+)(?:/(\w+))?\.json$', url.path)
+        if not match:
+            return self.reply(404, {})
+
+        resource, id = match.groups()
+        collections = {'users': data.users, 'projects': data.projects, 'issues': data.issues,
+                       'time_entries': data.time_entries, 'groups': data.groups}
+        if resource not in collections:
+            return self.reply(404, {})
+
+        if id is not None:
+            if id == 'current':
+                id = data.users[0]['id']
+            for item in collections[resource]:
+                if str(item['id']) == str(id):
+                    return self.reply(200, {resource[:-1]: item})
+            return self.reply(404, {})
+
+        items = [item for item in collections[resource] if self.matches(item, params)]
+        offset = int(params.get('offset', 0))
+        limit = min(int(params.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        self.reply(200, {resource: items[offset:offset + limit], 'total_count': len(items),
+                         'offset': offset, 'limit': limit})
+
+    def matches(self, item, params):
+        # python-redmine sends from_date and to_date as from and to.
+        if 'from' in params and item['spent_on'] < params['from']:
+            return False
+        if 'to' in params and item['spent_on'] > params['to']:
+            return False
+        if 'user_id' in params and str(item['user']['id']) not in params['user_id'].split('|'):
+            return False
+        if 'issue_id' in params and str(item['id']) not in params['issue_id'].split(','):
+            return False
+        if params.get('updated_on', '').startswith('>=') and item['updated_on'] < params['updated_on'][2:]:
+            return False
+        return True
+
+    def reply(self, status, body):
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeRedmineServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server answering Redmine API requests from a
+    SyntheticData instance, waiting latency seconds before each answer.
+    """
+    daemon_threads = True
+
+    def __init__(self, data, latency=0.0, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeRedmineHandler)
+        self.data = data
+        self.latency = latency
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def record_request(self):
+        with self._lock:
+            self.request_count += 1
+
+    def start(self):
+        """
+        Serves requests from a background thread.
+        :return: None
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
@@ -1,54 +1,190 @@
 __author__ = 'amrodriguez'
 
+import array
+import BaseHTTPServer
+import codecs
+import contextlib
+import csv
 import datetime
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import Queue
 import os
+import random
 import re
+import sqlite3
 import sys
+import threading
+import time
 import webbrowser
 import ConfigParser
 import argparse
+import multiprocessing
 import path
-import requests.packages.urllib3
-from redmine import Redmine
-from redmine import exceptions as rm_exceptions
-from requests import exceptions as req_exceptions
-from mako.template import Template
+from multiprocessing.pool import ThreadPool
 
-requests.packages.urllib3.disable_warnings()
+# python-redmine, requests and mako take a large share of the start up time,
+# so they are imported only when a Redmine client or a template is needed.
 
 if hasattr(sys, "frozen") and sys.frozen in ("windows_exe", "console_exe"):
     app_path = path.path(os.path.abspath(sys.executable)).dirname()
 else:
     app_path = os.path.dirname(os.path.realpath(__file__))
 
+if os.getenv('APPDATA'):
+    USER_CONFIG_DIR = os.getenv('APPDATA')
+elif sys.platform == 'darwin':
+    USER_CONFIG_DIR = os.path.expanduser('~/Library/Application Support/weekly')
+else:
+    USER_CONFIG_DIR = os.path.join(os.getenv('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), 'weekly')
+
 CONFIG_FILE = os.path.join(app_path, 'weekly.ini')
-PRIV_CONF_FILE = os.path.join(os.getenv('APPDATA'), 'weekly.conf')
+PRIV_CONF_FILE = os.path.join(USER_CONFIG_DIR, 'weekly.conf')
+TEMPLATE_FILE = os.path.join(app_path, 'template.htm')
+
+if sys.platform == 'win32':
+    USER_CACHE_DIR = os.path.join(os.getenv('LOCALAPPDATA') or os.getenv('APPDATA'), 'weekly', 'Cache')
+elif sys.platform == 'darwin':
+    USER_CACHE_DIR = os.path.expanduser('~/Library/Caches/weekly')
+else:
+    USER_CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'weekly')
+
+RENDER_BUFFER_SIZE = 64 * 1024
+HTML_TAG_REGEX = re.compile(r'<[^>]+>')
+
+FUZZY_WORD_REGEX = re.compile(r'[^\W\d_]+', re.UNICODE)
+
+# Report sections in display order, as (key, heading) pairs. A key is either
+# one of the tags of the [TAGS] section or one of the built-in sections
+# ACHIEVEMENTS_SECTION and OTHER_TASKS_SECTION. Can be overridden with a
+# [SECTIONS] section in weekly.ini.
+ACHIEVEMENTS_SECTION = 'achievements'
+OTHER_TASKS_SECTION = 'other_tasks'
+DEFAULT_SECTIONS = [('issue', 'Main Issues of the Week'),
+                    (ACHIEVEMENTS_SECTION, 'Main Achievements of the Week'),
+                    ('shortterm', 'Short Term Priorities'),
+                    ('help', 'Subjects Requiring Help'),
+                    (OTHER_TASKS_SECTION, 'Others Activities'),
+                    ('forecasted', 'Forecasted Activities/Projects')]
+
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Redmine caps page size at 100 and most servers/proxies reject URLs much
+# longer than 2k characters, so batched issue filters are chunked on both.
+MAX_PAGE_LIMIT = 100
+MAX_ID_LIST_CHARS = 1500
+
+CACHE_FILE = os.path.join(os.path.dirname(PRIV_CONF_FILE), 'weekly.cache')
+DEFAULT_CACHE_SIZE = 5000
+# Redmine cannot filter or sort projects by update time, so the persisted
+# project catalog is reloaded when the project count changes or once it gets
+# older than this.
+PROJECT_CACHE_MAX_AGE = datetime.timedelta(days=1)
+REDMINE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+STATUS_CODE_REGEX = re.compile(r'code (\d{3})\b')
+
+# Report snapshots are gzipped JSON lines: a header with the format name and
+# version, then one [type, attributes] record per time entry, issue and
+# project the report was built from.
+SNAPSHOT_FORMAT = 'weekly-snapshot'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = '.snapshot.jsonl.gz'
+
+# Seconds between polls of --watch when no interval is given.
+DEFAULT_WATCH_INTERVAL = 300
 
 class Weekly(object):
 
-    def __init__(self, args, api_key, main_project_id, other_tasks_id, tags, rm_url):
-        self.redmine = Redmine(rm_url, key=api_key, requests={'verify': False})
-        self.user = self.redmine.user.get('current')
+    def __init__(self, args, api_key, main_project_id, other_tasks_id, tags, rm_url, workers=1,
+                 disk_cache=None, page_size=MAX_PAGE_LIMIT, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 rate_limit=0, profiler=None, sections=None, fuzzy_subitems=False, incremental=False, user=None):
+        self.profiler = profiler or Profiler()
+        self.disk_cache = disk_cache
+        self._redmine = None
+        self._redmine_settings = dict(url=rm_url,
+                                      key=api_key,
+                                      requests={'verify': False, 'timeout': timeout},
+                                      pool_size=max(1, workers),
+                                      retries=retries,
+                                      rate_limit=rate_limit,
+                                      profiler=self.profiler)
+
+        self.user = user
+        if self.user is None:
+            with self.profiler.phase('user_lookup'):
+                self.user = self.get_current_user(api_key)
         self.weeknum, self.daynum = datetime.date.today().isocalendar()[1:]
-        self.mytemplate = Template(filename='template.htm',
-                                   module_directory=os.getenv('Temp'),
-                                   default_filters=['decode.utf8'],
-                                   input_encoding='utf-8',
-                                   output_encoding='utf-8')
 
         self.last_week = args.last_week
+        self.offline = args.offline
+        self.save_snapshot = args.snapshot
+        self.formats = args.formats
         if self.last_week:
-            self.weeknum -= 1
+            self.weeknum = self.get_last_week_start().isocalendar()[1]
+
+        self.from_date = args.from_date
+        self.to_date = args.to_date
+        self.weeks = args.weeks
+        self.combined = args.combined
 
         self.main_project_id = main_project_id
         self.other_tasks_id = other_tasks_id
+        self.sections = sections or DEFAULT_SECTIONS
+        self.fuzzy_subitems = fuzzy_subitems
 
-        self.known_tags = [t.lower() for t in tags]
+        self.tag_matcher = TagMatcher(tags)
+        self.parsed_comments = {}
         self.project_cache = {}
         self.issue_cache = {}
         self.tag_cloud = {}
+        self.tagged_ids = set()
+
+        self.workers = max(1, workers)
+        self.page_size = min(max(1, page_size), MAX_PAGE_LIMIT)
+        self.requests_saved = 0
+        self._cache_lock = threading.Lock()
+        self._fetch_locks = {}
 
-        self.tag_regex = re.compile(r'.*#(\w+)')
+        # Only long running modes keep the sections and the digest of each
+        # report rendered, to rebuild and rewrite only what changed.
+        self.section_cache = {} if incremental else None
+        self.rendered_digests = {} if incremental else None
+
+    @property
+    def redmine(self):
+        """
+        The Redmine client, created on first use.
+        """
+        if self._redmine is None:
+            self._redmine = make_redmine(**self._redmine_settings)
+        return self._redmine
+
+    def get_current_user(self, api_key):
+        """
+        Retrieves the user the API key belongs to. The user is kept in the
+        persistent cache under a hash of the key, so the server is asked only
+        the first time a key is used.
+        :param api_key: The Redmine API key in use.
+        :return: A CurrentUser instance.
+        """
+        key = 'current_user:{}'.format(hashlib.sha1(api_key).hexdigest())
+        if self.disk_cache is not None:
+            cached = self.disk_cache.get_meta(key)
+            if cached:
+                return CurrentUser(**json.loads(cached))
+
+        user = self.redmine.user.get('current')
+        current = CurrentUser(user.id, user.firstname, user.lastname)
+        if self.disk_cache is not None:
+            self.disk_cache.set_meta(key, json.dumps(current.__dict__))
+        return current
 
     def fetch_issue(self, id):
         """
@@ -57,13 +193,7 @@ class Weekly(object):
         :param id: ID of the issue to retrieve.
         :return: The redmine.issue instance retrieved.
         """
-        try:
-            return self.issue_cache[id]
-
-        except KeyError:
-            issue = self.redmine.issue.get(id)
-            self.issue_cache[id] = issue
-            return issue
+        return self._fetch_cached(self.issue_cache, 'issue', id)
 
     def fetch_project(self, id):
         """
@@ -72,13 +202,201 @@ class Weekly(object):
         :param id: ID of the project to retrieve.
         :return: The redmine.project instance retrieved.
         """
-        try:
-            return self.project_cache[id]
+        return self._fetch_cached(self.project_cache, 'project', id)
 
+    def _fetch_cached(self, cache, resource_name, id):
+        """
+        Retrieves a resource by ID through the given cache. Safe to call from
+        several threads: concurrent requests for the same ID wait for the
+        first one instead of fetching the resource again.
+        :param cache: The cache dictionary of the resource type.
+        :param resource_name: Name of the Redmine resource. May be issue or
+                              project.
+        :param id: ID of the resource to retrieve.
+        :return: The resource instance retrieved.
+        """
+        try:
+            resource = cache[id]
+            self.profiler.count(resource_name + '_cache.hit')
+            return resource
         except KeyError:
-            project = self.redmine.project.get(id)
-            self.project_cache[id] = project
-            return project
+            pass
+
+        with self._fetch_lock(resource_name, id):
+            if not self._load_from_disk(cache, resource_name, id):
+                resource = getattr(self.redmine, resource_name).get(id)
+                self._store(cache, resource_name, resource)
+
+        return cache[id]
+
+    def _fetch_lock(self, resource_name, id):
+        """
+        Retrieves the lock held while a resource is being loaded, so the
+        resource is requested only once when several threads need it.
+        :param resource_name: Name of the Redmine resource. May be issue or
+                              project.
+        :param id: ID of the resource.
+        :return: The threading.Lock instance of the resource.
+        """
+        with self._cache_lock:
+            return self._fetch_locks.setdefault((resource_name, id), threading.Lock())
+
+    def _load_from_disk(self, cache, resource_name, id):
+        """
+        Makes sure the resource is in the memory cache, loading it from the
+        persistent cache if needed.
+        :param cache: The cache dictionary of the resource type.
+        :param resource_name: Name of the Redmine resource. May be issue or
+                              project.
+        :param id: ID of the resource to look for.
+        :return: True if the resource is now in the memory cache, False if it
+                 has to be fetched from the server.
+        """
+        if id in cache:
+            self.profiler.count(resource_name + '_cache.hit')
+            return True
+
+        attributes = None
+        if self.disk_cache is not None:
+            attributes = self.disk_cache.get(resource_name, id)
+
+        if attributes is None:
+            self.profiler.count(resource_name + '_cache.miss')
+            return False
+
+        self.profiler.count(resource_name + '_cache.disk_hit')
+        cache[id] = getattr(self.redmine, resource_name).to_resource(attributes)
+        return True
+
+    def _store(self, cache, resource_name, resource):
+        """
+        Adds a resource retrieved from the server to the memory cache and to
+        the persistent cache, if enabled.
+        :param cache: The cache dictionary of the resource type.
+        :param resource_name: Name of the Redmine resource. May be issue or
+                              project.
+        :param resource: The resource instance to store.
+        :return: None
+        """
+        cache[resource.id] = resource
+        if self.disk_cache is not None:
+            self.disk_cache.put(resource_name, resource)
+
+    def revalidate_disk_cache(self):
+        """
+        Refreshes outdated issues of the persistent cache with a single filter
+        on updated_on since the last run.
+        :return: None
+        """
+        if self.disk_cache is None or self.offline:
+            return
+
+        with self.profiler.phase('cache_revalidation'):
+            now = datetime.datetime.utcnow()
+
+            synced_on = self.disk_cache.get_meta('issue_synced_on')
+            cached_ids = set(self.disk_cache.ids('issue'))
+            if synced_on and cached_ids:
+                issues = self.redmine.issue.filter(updated_on='>=' + synced_on, status_id='*')
+                for issue in issues:
+                    if issue.id in cached_ids:
+                        self.disk_cache.put('issue', issue)
+                    if issue.id in self.issue_cache:
+                        self.issue_cache[issue.id] = issue
+            else:
+                self.disk_cache.clear('issue')
+            self.disk_cache.set_meta('issue_synced_on', now.strftime(REDMINE_TIME_FORMAT))
+
+    def load_project_catalog(self):
+        """
+        Fills the project cache with every project visible to the user,
+        parents included, so project lookups need no further requests. The
+        catalog is kept in the persistent cache and listed again from the
+        server only when the project count changed or the catalog is older
+        than PROJECT_CACHE_MAX_AGE. Does nothing without a persistent cache,
+        since a full listing on every run would cost more than it saves.
+        :return: None
+        """
+        if self.disk_cache is None or self.project_cache:
+            return
+
+        now = datetime.datetime.utcnow()
+        synced_on = self.disk_cache.get_meta('project_synced_on')
+        cached = self.disk_cache.get_all('project')
+
+        if not self.offline:
+            fresh = (synced_on and
+                     now - datetime.datetime.strptime(synced_on, REDMINE_TIME_FORMAT) <= PROJECT_CACHE_MAX_AGE and
+                     total_count(self.redmine.project.all(limit=1)) == len(cached))
+            if not fresh:
+                self.disk_cache.clear('project')
+                for project in self.redmine.project.all():
+                    self._store(self.project_cache, 'project', project)
+                self.disk_cache.set_meta('project_synced_on', now.strftime(REDMINE_TIME_FORMAT))
+                return
+
+        for attributes in cached:
+            self.project_cache[attributes['id']] = self.redmine.project.to_resource(attributes)
+
+    def resolve_concurrently(self, issue_ids):
+        """
+        Retrieves the given issues using a pool of self.workers threads,
+        filling the memory cache.
+        :param issue_ids: Iterable of issue IDs to retrieve.
+        :return: None
+        """
+        issue_ids = set(issue_ids)
+        pool = ThreadPool(self.workers)
+        try:
+            pool.map(self.fetch_issue, [i for i in issue_ids if i not in self.issue_cache])
+        finally:
+            pool.close()
+            pool.join()
+
+    def prefetch_issues(self, issue_ids):
+        """
+        Loads all the given issues that are not in the memory cache yet using
+        as few requests as possible, and adds them to the cache. Issues the
+        server does not return are left for fetch_issue to retrieve. Offline
+        the issues are only loaded from the persistent cache.
+        Safe to call from several threads: the fetch lock of each missing
+        issue is held until its filter request is done, and issues another
+        thread is already loading are skipped.
+        The number of requests saved compared to fetching each issue
+        individually is added to self.requests_saved.
+        :param issue_ids: Iterable of issue IDs to load.
+        :return: None
+        """
+        reserved = {}
+        for i in sorted(set(issue_ids)):
+            if i in self.issue_cache:
+                continue
+            lock = self._fetch_lock('issue', i)
+            if not lock.acquire(False):
+                continue
+            if self._load_from_disk(self.issue_cache, 'issue', i) or self.offline:
+                lock.release()
+            else:
+                reserved[i] = lock
+
+        missing = len(reserved)
+        requests_made = 0
+        try:
+            for chunk in chunk_ids(sorted(reserved)):
+                issues = self.redmine.issue.filter(issue_id=','.join(str(i) for i in chunk),
+                                                   status_id='*',
+                                                   limit=len(chunk))
+                for issue in issues:
+                    self._store(self.issue_cache, 'issue', issue)
+                requests_made += 1
+                for i in chunk:
+                    reserved.pop(i).release()
+        finally:
+            for lock in reserved.values():
+                lock.release()
+
+        with self._cache_lock:
+            self.requests_saved += missing - requests_made
 
     def get_week_start(self):
         """
@@ -111,58 +429,200 @@ class Weekly(object):
     def get_time_entries_range(self, startdate, enddate):
         """
         Retrieves all time entries within the given date range from the
-        Redmine server.
+        Redmine server, or from the local time entry store when the persistent
+        cache is enabled.
+        :param startdate: Start date of search.
+        :param enddate: End date of search.
+        :return: A list of TimeEntry objects.
+        """
+        if self.disk_cache is None:
+            return self.fetch_time_entries(from_date=startdate, to_date=enddate, user_id=self.user.id)
+
+        if not self.offline:
+            self.sync_time_entries(startdate, enddate)
+
+        return self.get_stored_time_entries(startdate, enddate)
+
+    def stream_time_entries(self, **filters):
+        """
+        Retrieves time entries page by page. A background thread downloads
+        the pages one ahead of the consumer, so a page can be processed while
+        the next one is in flight.
+        :param filters: Filters of the time entry query.
+        :return: A generator of lists of time entry attribute dictionaries,
+                 one per page.
+        """
+        pages = Queue.Queue(maxsize=2)
+
+        def download():
+            try:
+                offset = 0
+                while True:
+                    resources = self.redmine.time_entry.filter(offset=offset, limit=self.page_size, **filters)
+                    page = [resource_attributes(te) for te in resources]
+                    pages.put(page)
+                    offset += len(page)
+                    if not page or offset >= resources.total_count:
+                        break
+            except Exception:
+                pages.put(sys.exc_info())
+            pages.put(None)
+
+        downloader = threading.Thread(target=download)
+        downloader.daemon = True
+        downloader.start()
+
+        while True:
+            page = pages.get()
+            if page is None:
+                break
+            if isinstance(page, tuple):
+                raise page[0], page[1], page[2]
+            yield page
+
+    def fetch_time_entries(self, **filters):
+        """
+        Retrieves all time entries matching the filters. The comments of each
+        page are parsed and its issues prefetched as soon as it arrives, while
+        the following pages are still downloading.
+        :param filters: Filters of the time entry query.
+        :return: A list of TimeEntry objects.
+        """
+        time_entries = []
+        for page in self.stream_time_entries(**filters):
+            page = [TimeEntry.from_attributes(attributes) for attributes in page]
+            for te in page:
+                self.parse_comments(te)
+            self.prefetch_issues(te.issue_id for te in page if te.issue_id is not None)
+            time_entries.extend(page)
+
+        return time_entries
+
+    def get_stored_time_entries(self, startdate, enddate):
+        """
+        Retrieves the time entries within the given date range from the local
+        time entry store, without contacting the server.
         :param startdate: Start date of search.
         :param enddate: End date of search.
-        :return: A list of redmine.time_entry objects.
+        :return: A list of TimeEntry objects.
         """
-        time_entries = self.redmine.time_entry.filter(from_date=startdate,
-                                                      to_date=enddate,
-                                                      user_id=self.user.id)
-        return [te for te in time_entries]
+        return [TimeEntry.from_attributes(attributes)
+                for attributes in self.disk_cache.time_entries(self.user.id, startdate, enddate)]
 
-    def extract_by_id(self, time_entries, ids, resource_name):
+    def get_time_entries_windows(self, windows):
+        """
+        Retrieves the time entries of several date ranges. Without a local
+        store the ranges are fetched concurrently using self.workers threads;
+        with a store the whole span is synced once and each range is read
+        back locally.
+        :param windows: List of (startdate, enddate) tuples.
+        :return: A dictionary where the keys are the tuples given and the
+                 values are lists of TimeEntry objects.
         """
-        Takes a list of time entries and retrieves the resource indicates
-        by resource_name. If the ID of the resource matches one of the IDs
-        in the ids list given, the time entry is removed from the list.
+        if self.disk_cache is not None:
+            if not self.offline:
+                self.sync_time_entries(windows[0][0], windows[-1][1])
+            return dict((w, self.get_stored_time_entries(*w)) for w in windows)
+
+        pool = ThreadPool(self.workers)
+        try:
+            results = pool.map(lambda w: self.get_time_entries_range(*w), windows)
+        finally:
+            pool.close()
+            pool.join()
 
-        :param time_entries: List of redmine.time_entry objects.
-        :param ids: IDs of resources of time entries to remove.
-        :param resource_name: Name of the resource to check for in the time
-        entries. May be issue or project.
-        :return: List of time entries removed from the list.
+        return dict(zip(windows, results))
+
+    def sync_time_entries(self, startdate, enddate):
+        """
+        Brings the local time entry store up to date for the given date range.
+        The first time a range is requested all its entries are fetched. After
+        that only the entries created or updated since the last sync are
+        fetched, and the range is fully listed again only when the server
+        reports a different number of entries than the store holds, which
+        means some were deleted.
+        :param startdate: Start date of the range.
+        :param enddate: End date of the range.
+        :return: None
         """
-        if not hasattr(ids, '__contains__'):
-            ids = [ids]
+        store = self.disk_cache
+        user_id = self.user.id
+        sync_key = 'time_entry_synced_on:{}'.format(user_id)
+        now = datetime.datetime.utcnow()
+
+        synced_on = store.get_meta(sync_key)
+        if synced_on:
+            for page in self.stream_time_entries(user_id=user_id, updated_on='>=' + synced_on):
+                for attributes in page:
+                    store.put_time_entry(attributes)
+
+        if not store.covers(user_id, startdate, enddate):
+            window = self.stream_time_entries(from_date=startdate, to_date=enddate, user_id=user_id)
+            store.replace_time_entries(user_id, startdate, enddate,
+                                       (attributes for page in window for attributes in page))
+            store.add_coverage(user_id, startdate, enddate)
+        else:
+            total = total_count(self.redmine.time_entry.filter(from_date=startdate,
+                                                               to_date=enddate,
+                                                               user_id=user_id,
+                                                               limit=1))
+            if total != store.count_time_entries(user_id, startdate, enddate):
+                window = self.stream_time_entries(from_date=startdate, to_date=enddate, user_id=user_id)
+                store.replace_time_entries(user_id, startdate, enddate,
+                                           (attributes for page in window for attributes in page))
+
+        store.set_meta(sync_key, now.strftime(REDMINE_TIME_FORMAT))
+
+    def classify(self, time_entries):
+        """
+        Routes each time entry to its report sections in a single pass: other
+        tasks, main project or everything else, plus one list per known tag
+        found in its comments. An entry may carry several tags. Fills the
+        tag_cloud and tagged_ids instance variables.
+
+        :param time_entries: List of TimeEntry objects.
+        :return: A tuple (other_tasks, main_project, everything_else) of lists
+                 of time entries.
+        """
+        other_tasks_ids = id_set(self.other_tasks_id)
+        main_project_ids = id_set(self.main_project_id)
+        self.tag_cloud = {}
+        self.tagged_ids = set()
+        other_tasks, main_project, everything_else = [], [], []
 
-        filtered = []
-        for te in time_entries[:]:
-            rsc = getattr(te, resource_name)
-            if rsc.id in ids:
-                filtered.append(te)
-                time_entries.remove(te)
+        for te in time_entries:
+            for tag in self.parse_comments(te)[1]:
+                self.tag_cloud.setdefault(tag, []).append(te)
+                self.tagged_ids.add(te.id)
+
+            if te.issue_id in other_tasks_ids:
+                other_tasks.append(te)
+            elif te.project_id in main_project_ids:
+                main_project.append(te)
+            else:
+                everything_else.append(te)
 
-        return filtered
+        return other_tasks, main_project, everything_else
 
     def mk_dict_by_rsc_type(self, time_entries, resource_name):
         """
         Generated a dictionary where the keys are the ID of the resource
-        described by resource_name (issue or project), and the values are a
-        list of time entries that belong to that resource.
+        described by resource_name (issue, project or user), and the values
+        are a list of time entries that belong to that resource.
 
-        :param time_entries: List of time_entry objects.
+        :param time_entries: List of TimeEntry objects.
         :param resource_name: Name of the resource to group the in the time
-                              entries by. May be issue or project.
+                              entries by. May be issue, project or user.
         :return: The dictionary created.
         """
 
+        attr = resource_name + '_id'
         rsc_dict = {}
         for te in time_entries:
-            rsc = getattr(te, resource_name)
-            if rsc.id not in rsc_dict:
-                rsc_dict[rsc.id] = []
-            rsc_dict[rsc.id].append(te)
+            rsc_id = getattr(te, attr)
+            if rsc_id not in rsc_dict:
+                rsc_dict[rsc_id] = []
+            rsc_dict[rsc_id].append(te)
 
         return rsc_dict
 
@@ -176,26 +636,29 @@ class Weekly(object):
         in the time entries linked to the Issues.
 
         :param issue_te_dict: A dictionary where the keys are issue IDs and
-                              the values are lists of time_entry objects.
+                              the values are lists of TimeEntry objects.
         :param include_tagged: Flag True or False to include comments that
                                contain tags or not. Defaults to False.
         :return: The list of Presentable objects created.
         """
         items = []
         for issue_id, issue_te_dict in issue_te_dict.items():
-            item = Presentable()
+            if issue_id is None:
+                items += self.make_presentables_without_issue(issue_te_dict, include_tagged)
+                continue
+
+            item = Presentable(fuzzy=self.fuzzy_subitems)
             rm_issue = self.fetch_issue(issue_id)
             if rm_issue.project.id == self.main_project_id:
                 item.title = u'{}: <b><i>{}</i></b>'.format(rm_issue.subject, self.get_completeness_string(rm_issue))
             else:
-                rm_proj = self.fetch_project(rm_issue.project.id)
-                item.title = rm_proj.name
+                item.title = rm_issue.project.name
 
             for te in issue_te_dict:
-                comments = self.strip_tags(te.comments)
+                comments = self.parse_comments(te)[0]
                 if comments:
                     if include_tagged or not self.is_in_tag_cloud(te):
-                        item.add_subitem(comments)
+                        item.add_subitem(comments, te.hours)
             items.append(item)
 
         return items
@@ -209,22 +672,26 @@ class Weekly(object):
         in the time entries linked to the Issues.
 
         :param issue_te_dict: A dictionary where the keys are issue IDs and
-                              the values are lists of time_entry objects.
+                              the values are lists of TimeEntry objects.
         :param include_tagged: Flag True or False to include comments that
                                contain tags or not. Defaults to False.
         :return: The list of Presentable objects created.
         """
         items = []
         for issue_id, issue_te_dict in issue_te_dict.items():
-            issue = Presentable()
+            if issue_id is None:
+                items += self.make_presentables_without_issue(issue_te_dict, include_tagged)
+                continue
+
+            issue = Presentable(fuzzy=self.fuzzy_subitems)
             rm_issue = self.fetch_issue(issue_id)
             issue.title = u'{}: <b><i>{}</i></b>'.format(rm_issue.subject, self.get_completeness_string(rm_issue))
 
             for te in issue_te_dict:
-                comments = self.strip_tags(te.comments)
+                comments = self.parse_comments(te)[0]
                 if comments:
                     if include_tagged or not self.is_in_tag_cloud(te):
-                        issue.add_subitem(comments)
+                        issue.add_subitem(comments, te.hours)
             items.append(issue)
 
         return items
@@ -233,32 +700,65 @@ class Weekly(object):
         """
         Generates a list of Presentable instances from a dictionary of time
         entries grouped by project. The Presentable subitems are the subjects
-        of the issues linked the Projects.
+        of the issues linked the Projects, and the comments of the time
+        entries not linked to an issue.
 
         :param project_te_dict: A dictionary where the keys are project IDs and
-                                the values are lists of time_entry objects.
+                                the values are lists of TimeEntry objects.
         :return: The list of Presentable objects created.
         """
         projects = []
         for project_id, time_entries in project_te_dict.items():
-            project = Presentable()
-            rm_proj = self.fetch_project(project_id)
-            project.title = rm_proj.name
+            project = Presentable(fuzzy=self.fuzzy_subitems)
+            project.title = time_entries[0].project_name or self.fetch_project(project_id).name
 
             issues_dict = self.mk_dict_by_rsc_type(time_entries, 'issue')
 
-            for issue_id, te in issues_dict.items():
+            for issue_id, issue_time_entries in issues_dict.items():
+                if issue_id is None:
+                    for te in issue_time_entries:
+                        comments = self.parse_comments(te)[0]
+                        if comments:
+                            project.add_subitem(comments, te.hours)
+                    continue
+
                 rm_issue = self.fetch_issue(issue_id)
-                project.add_subitem(rm_issue.subject)
+                project.add_subitem(rm_issue.subject, sum(te.hours for te in issue_time_entries))
 
             projects.append(project)
 
         return projects
 
+    def make_presentables_without_issue(self, time_entries, include_tagged=False):
+        """
+        Generates a list of Presentable instances from time entries not
+        linked to an issue, one per project.
+        The Presentable's title is the project name.
+        The Presentable's subitems are the comments in the time entries.
+
+        :param time_entries: A list of TimeEntry objects.
+        :param include_tagged: Flag True or False to include comments that
+                               contain tags or not. Defaults to False.
+        :return: The list of Presentable objects created.
+        """
+        items = []
+        for project_id, project_te in self.mk_dict_by_rsc_type(time_entries, 'project').items():
+            item = Presentable(fuzzy=self.fuzzy_subitems)
+            item.title = project_te[0].project_name or self.fetch_project(project_id).name
+
+            for te in project_te:
+                comments = self.parse_comments(te)[0]
+                if comments:
+                    if include_tagged or not self.is_in_tag_cloud(te):
+                        item.add_subitem(comments, te.hours)
+            items.append(item)
+
+        return items
+
     def mk_pres_obj_from_time_entries(self, time_entries):
         """
         Generates Presntable instances from the given list of time entries.
-        :param time_entries:  A list of redmine.time_entry objects.
+        :param time_entries:  A list of TimeEntry objects.
         :return: A list of the Presentable objects created.
         """
 
@@ -271,33 +771,21 @@ class Weekly(object):
 
         return entries
 
-    def mine_hashtags(self, time_entries):
+    def parse_comments(self, time_entry):
         """
-        Searches the given time entries for tags and adds any new tag to the
-        tag_cloud instance variable with a reference tot he time entry object
-        that contains it.
-        :param time_entries: A list of redmine.time_entry objects.
-        :return: None
-        """
-        for te in time_entries:
-            tags = self.tag_regex.findall(te.comments.lower())
-            for tag in [t.lower() for t in tags if t.lower() in self.known_tags]:
-                if tag not in self.tag_cloud:
-                    self.tag_cloud[tag] = []
-                self.tag_cloud[tag].append(te)
-
-    def strip_tags(self, text):
+        Parses the comments of a time entry, only once per entry and version
+        of its comments.
+        :param time_entry: A TimeEntry object.
+        :return: A tuple (text, tags) with the comments stripped of tags and
+                 the set of known tags found.
         """
-        Removes known tags from the given text.
-        :param text: Text to search for tags.
-        :return: Text with tags removed.
-        """
-        tags = ['#{}'.format(t) for t in self.tag_regex.findall(text)]
-
-        for tag in tags:
-            text = text.replace(tag, '')
+        cached = self.parsed_comments.get(time_entry.id)
+        if cached is not None and cached[0] == time_entry.comments:
+            return cached[1]
 
-        return text.strip()
+        parsed = self.tag_matcher.parse(time_entry.comments)
+        self.parsed_comments[time_entry.id] = (time_entry.comments, parsed)
+        return parsed
 
     def get_completeness_string(self, issue):
         """
@@ -311,59 +799,405 @@ class Weekly(object):
             return u'In progress.'
 
     def is_in_tag_cloud(self, time_entry):
-        for tagged in self.tag_cloud.values():
-            if time_entry in tagged:
-                return True
+        return time_entry.id in self.tagged_ids
 
-        return False
+    def resolve_issues(self, time_entries):
+        """
+        Loads the issues and projects referenced by the given time entries
+        into the caches ahead of the presentable builders.
+        :param time_entries: A list of TimeEntry objects.
+        :return: None
+        """
+        with self.profiler.phase('issue_prefetch'):
+            self.load_project_catalog()
+
+            issue_ids = [te.issue_id for te in time_entries if te.issue_id is not None]
+            self.prefetch_issues(issue_ids)
+
+            if self.workers > 1:
+                self.resolve_concurrently(issue_ids)
+
+    def get_report_range(self):
+        """
+        Computes the date range requested with --from/--to or --weeks.
+        :return: A tuple (startdate, enddate), or None if no range was
+                 requested.
+        """
+        if self.from_date:
+            return self.from_date, self.to_date or datetime.date.today()
+
+        if self.weeks:
+            enddate = self.get_last_week_end() if self.last_week else self.get_week_end()
+            return enddate - datetime.timedelta(days=7 * self.weeks - 1), enddate
 
-    def report_week(self):
+        return None
+
+    def report_range(self, startdate, enddate):
+        """
+        Generates one report per ISO week within the given date range, or a
+        single report for the whole range if combined reports were requested.
+        The time entries of all the weeks are retrieved up front so that the
+        issue and project caches are shared across the reports.
+
+        :param startdate: Start date of the range.
+        :param enddate: End date of the range.
+        :return: A list with the filenames of the reports generated.
+        """
+        windows = week_windows(startdate, enddate)
+
+        self.revalidate_disk_cache()
+        with self.profiler.phase('time_entries'):
+            entries_by_window = self.get_time_entries_windows(windows)
+        self.resolve_issues([te for w in windows for te in entries_by_window[w]])
+
+        if self.combined:
+            time_entries = [te for w in windows for te in entries_by_window[w]]
+            return [self.report_week(startdate, enddate, time_entries)]
+
+        return [self.report_week(w[0], w[1], entries_by_window[w]) for w in windows]
+
+    def report_week(self, startdate=None, enddate=None, time_entries=None):
         """
         Generates a report for the week.
 
-        :return: The filename of the report generated.
+        :param startdate: Optional start date of the report. Defaults to the
+                          start of the current week, or of last week.
+        :param enddate: Optional end date of the report. Defaults to the end
+                        of the current week, or of last week.
+        :param time_entries: Optional list of the time entries of the range,
+                             when already retrieved.
+        :return: The filename of the report generated in the first of the
+                 requested formats.
         """
-        if self.last_week:
-            startdate = self.get_last_week_start()
-            enddate = self.get_last_week_end()
-        else:
-            startdate = self.get_week_start()
-            enddate = self.get_week_end()
+        if startdate is None:
+            if self.last_week:
+                startdate = self.get_last_week_start()
+                enddate = self.get_last_week_end()
+            else:
+                startdate = self.get_week_start()
+                enddate = self.get_week_end()
 
-        time_entries = self.get_time_entries_range(startdate, enddate)
+        if time_entries is None:
+            self.revalidate_disk_cache()
+            with self.profiler.phase('time_entries'):
+                time_entries = self.get_time_entries_range(startdate, enddate)
+            self.resolve_issues(time_entries)
 
-        for te in time_entries:
-            self.fetch_issue(te.issue.id)
+        filename, context = self.build_report(startdate, enddate, time_entries, self.user)
+        outputs = [output_filename(filename, fmt) for fmt in self.formats]
 
-        self.mine_hashtags(time_entries)
-        other_tasks_te = self.extract_by_id(time_entries, self.other_tasks_id, resource_name='issue')
-        main_project_te = self.extract_by_id(time_entries, self.main_project_id, resource_name='project')
+        # Save what was synced and cached for the report, so long running
+        # modes do not lose it if interrupted.
+        if self.disk_cache is not None:
+            self.disk_cache.commit()
 
-        main_project_te_dict = self.mk_dict_by_rsc_type(main_project_te, 'issue')
-        everything_else_dict = self.mk_dict_by_rsc_type(time_entries, 'project')
-        tags_dict = {}
+        if self.rendered_digests is not None:
+            digest = hashlib.sha1('\n'.join([section.digest for section in context['sections']] +
+                                             [repr(context['hours'])])).hexdigest()
+            if self.rendered_digests.get(filename) == digest and all(os.path.exists(o) for o in outputs):
+                self.profiler.count('render.skipped')
+                return outputs[0]
 
-        for tag, tagged_time_entries in self.tag_cloud.items():
-            dict_ = self.mk_dict_by_rsc_type(tagged_time_entries, resource_name='issue')
-            tags_dict[tag] = self.make_presentables_by_issues_(dict_, include_tagged=True)
+        with self.profiler.phase('rendering'):
+            render_outputs(filename, context, self.formats)
 
-        main_ach = []
-        main_ach += self.make_presentables_by_issue(main_project_te_dict)
-        main_ach += self.make_presentables_by_project(everything_else_dict)
+        if self.rendered_digests is not None:
+            self.rendered_digests[filename] = digest
 
-        other_tasks = self.mk_pres_obj_from_time_entries(other_tasks_te)
+        if self.save_snapshot:
+            with self.profiler.phase('snapshot'):
+                self.write_snapshot(os.path.splitext(filename)[0] + SNAPSHOT_SUFFIX, startdate, enddate, time_entries)
 
-        filename = '{}_WeeklyReport_{:02}.html'.format(str(self.user).replace(' ', ''), self.weeknum)
+        return outputs[0]
 
+    def write_snapshot(self, filename, startdate, enddate, time_entries, user=None):
+        """
+        Saves the time entries of a report, and the issues and projects they
+        reference, so the report can be rebuilt later without the server.
+        :param filename: Name of the snapshot file to write.
+        :param startdate: Start date of the report.
+        :param enddate: End date of the report.
+        :param time_entries: List of the TimeEntry objects of the report.
+        :param user: Optional CurrentUser the report belongs to. Defaults to
+                     self.user.
+        :return: None
+        """
+        user = user or self.user
+        issue_ids = set(te.issue_id for te in time_entries if te.issue_id is not None)
+        project_ids = set(te.project_id for te in time_entries)
+
+        header = {'format': SNAPSHOT_FORMAT,
+                  'version': SNAPSHOT_VERSION,
+                  'startdate': str(startdate),
+                  'enddate': str(enddate),
+                  'user': {'id': user.id, 'firstname': user.firstname, 'lastname': user.lastname}}
+        records = itertools.chain((('time_entry', te.to_attributes()) for te in time_entries),
+                                  (('issue', resource_attributes(self.fetch_issue(i))) for i in sorted(issue_ids)),
+                                  (('project', resource_attributes(self.project_cache[i]))
+                                   for i in sorted(project_ids) if i in self.project_cache))
+        write_snapshot(filename, header, records)
+
+    def report_snapshot(self, header, records):
+        """
+        Rebuilds a report from a snapshot, without contacting the server. The
+        issues and projects of the snapshot are loaded into the memory caches
+        as the records stream in.
+        :param header: The header of the snapshot, as returned by
+                       read_snapshot.
+        :param records: The records of the snapshot, as returned by
+                        read_snapshot.
+        :return: The filename of the report generated.
+        """
+        self.offline = True
+        self.save_snapshot = False
+
+        with self.profiler.phase('snapshot'):
+            time_entries = []
+            for resource_name, attributes in records:
+                if resource_name == 'time_entry':
+                    te = TimeEntry.from_attributes(attributes)
+                    self.parse_comments(te)
+                    time_entries.append(te)
+                elif resource_name == 'issue':
+                    self.issue_cache[attributes['id']] = self.redmine.issue.to_resource(attributes)
+                elif resource_name == 'project':
+                    self.project_cache[attributes['id']] = self.redmine.project.to_resource(attributes)
+
+        return self.report_week(parse_date(header['startdate']), parse_date(header['enddate']), time_entries)
+
+    def refresh_week(self):
+        """
+        Brings the report of the week up to date. Meant to be called
+        repeatedly by the long running modes: the caches are kept between
+        calls, only the time entries and issues updated since the previous
+        call are requested, only the sections whose inputs changed are
+        rebuilt and the report is rewritten only if any of them did.
+        :return: A tuple (filename, changed) with the filename of the report
+                 and whether it was written.
+        """
+        self.weeknum, self.daynum = datetime.date.today().isocalendar()[1:]
+        if self.last_week:
+            self.weeknum = self.get_last_week_start().isocalendar()[1]
 
-        with open(filename, 'w') as f:
-            f.write(self.mytemplate.render(achievements=main_ach,
-                                           other_tasks=other_tasks,
-                                           week_number=self.weeknum,
-                                           developer=self.user,
-                                           tags=tags_dict))
+        rendered = self.rendered_digests.copy()
+        filename = self.report_week()
+        return filename, self.rendered_digests.get(filename) != rendered.get(filename)
 
-        return filename
+    def watch(self, interval, lock=None):
+        """
+        Refreshes the report of the week every interval seconds until
+        interrupted. Connection errors are reported and retried on the next
+        poll.
+        :param interval: Seconds between polls.
+        :param lock: Optional lock held while refreshing, shared with the
+                     report server.
+        :return: None
+        """
+        from requests import exceptions as req_exceptions
+
+        lock = lock or threading.Lock()
+        while True:
+            time.sleep(interval)
+            try:
+                with lock:
+                    filename, changed = self.refresh_week()
+                if changed:
+                    print '{} Updated {}'.format(time.strftime('%H:%M:%S'), filename)
+            except (req_exceptions.ConnectionError, req_exceptions.Timeout):
+                print '{} Connection error. Retrying in {}s.'.format(time.strftime('%H:%M:%S'), interval)
+
+    def report_team(self, user_ids, startdate=None, enddate=None):
+        """
+        Generates the reports of several users at once. The time entries of
+        all the users are fetched with a single query per week, sharing the
+        issue and project caches, and the reports are rendered in parallel
+        worker processes. A snapshot is saved next to each report if requested.
+
+        :param user_ids: List of the IDs of the users to report.
+        :param startdate: Optional start date of the range. Defaults to the
+                          current week, or last week.
+        :param enddate: Optional end date of the range.
+        :return: A list with the filenames of the reports generated, in every
+                 requested format.
+        """
+        started = time.time()
+        if startdate is None:
+            if self.last_week:
+                startdate, enddate = self.get_last_week_start(), self.get_last_week_end()
+            else:
+                startdate, enddate = self.get_week_start(), self.get_week_end()
+
+        windows = week_windows(startdate, enddate)
+        if self.combined:
+            windows = [(startdate, enddate)]
+
+        pool = ThreadPool(self.workers)
+        try:
+            team_filter = '|'.join(str(i) for i in user_ids)
+            with self.profiler.phase('time_entries'):
+                results = pool.map(lambda w: self.fetch_time_entries(from_date=w[0],
+                                                                     to_date=w[1],
+                                                                     user_id=team_filter),
+                                   windows)
+        finally:
+            pool.close()
+            pool.join()
+
+        entry_count = sum(len(entries) for entries in results)
+        self.resolve_issues([te for entries in results for te in entries])
+
+        reports, report_entries = [], []
+        for window, entries in zip(windows, results):
+            for user_entries in self.mk_dict_by_rsc_type(entries, 'user').values():
+                developer = user_entries[0].user_name
+                reports.append(self.build_report(window[0], window[1], user_entries, developer))
+                report_entries.append((window, user_entries))
+
+        processes = multiprocessing.Pool(min(self.workers, len(reports)) or 1)
+        try:
+            with self.profiler.phase('rendering'):
+                outputs = processes.map(render_report, [(report, self.formats) for report in reports])
+        finally:
+            processes.close()
+            processes.join()
+
+        if self.save_snapshot:
+            with self.profiler.phase('snapshot'):
+                for (filename, context), (window, user_entries) in zip(reports, report_entries):
+                    firstname, _, lastname = (user_entries[0].user_name or u'').partition(u' ')
+                    user = CurrentUser(user_entries[0].user_id, firstname, lastname)
+                    self.write_snapshot(os.path.splitext(filename)[0] + SNAPSHOT_SUFFIX,
+                                        window[0], window[1], user_entries, user)
+
+        if self.disk_cache is not None:
+            self.disk_cache.commit()
+
+        elapsed = time.time() - started
+        print 'Generated {} reports for {} users from {} time entries in {:.2f}s ({:.1f} reports/s).'.format(
+            len(reports), len(user_ids), entry_count, elapsed, len(reports) / elapsed if elapsed else 0)
+
+        return [filename for filenames in outputs for filename in filenames]
+
+    def build_report(self, startdate, enddate, time_entries, developer):
+        """
+        Groups the given time entries into the report sections, in the order
+        of self.sections.
+
+        :param startdate: Start date of the report.
+        :param enddate: End date of the report.
+        :param time_entries: List of the time entries of the report.
+        :param developer: The user the report belongs to.
+        :return: A tuple (filename, context) with the name of the report file
+                 and the keyword arguments to render the template with.
+        """
+        with self.profiler.phase('tag_mining'):
+            other_tasks_te, main_project_te, everything_else_te = self.classify(time_entries)
+
+        with self.profiler.phase('grouping'):
+            main_project_te_dict = self.mk_dict_by_rsc_type(main_project_te, 'issue')
+            everything_else_dict = self.mk_dict_by_rsc_type(everything_else_te, 'project')
+            tagged_dicts = dict((key, self.mk_dict_by_rsc_type(self.tag_cloud.get(key, []), resource_name='issue'))
+                                for key, heading in self.sections)
+
+        user_name = unicode(developer).replace(u' ', u'')
+        weeknum = startdate.isocalendar()[1]
+        if enddate - startdate > datetime.timedelta(days=6):
+            week_number = '{:02}-{:02}'.format(weeknum, enddate.isocalendar()[1])
+            filename = u'{}_Report_{}_{}.html'.format(user_name, startdate, enddate)
+        else:
+            week_number = weeknum
+            filename = u'{}_WeeklyReport_{:02}.html'.format(user_name, weeknum)
+
+        with self.profiler.phase('presentables'):
+            sections = []
+            for key, heading in self.sections:
+                if key == ACHIEVEMENTS_SECTION:
+                    section_te = main_project_te + everything_else_te
+                elif key == OTHER_TASKS_SECTION:
+                    section_te = other_tasks_te
+                else:
+                    section_te = self.tag_cloud.get(key, [])
+
+                digest = None
+                if self.section_cache is not None:
+                    digest = self.section_digest(key, section_te)
+                    cached = self.section_cache.get((filename, key))
+                    if cached is not None and cached.digest == digest:
+                        self.profiler.count('section.reused')
+                        sections.append(cached)
+                        continue
+
+                if key == ACHIEVEMENTS_SECTION:
+                    items = self.make_presentables_by_issue(main_project_te_dict)
+                    items += self.make_presentables_by_project(everything_else_dict)
+                    section = Section(key, heading, items, section_te, digest=digest)
+                elif key == OTHER_TASKS_SECTION:
+                    items = self.mk_pres_obj_from_time_entries(other_tasks_te)
+                    section = Section(key, heading, items, section_te, flat=True, digest=digest)
+                else:
+                    items = self.make_presentables_by_issues_(tagged_dicts[key], include_tagged=True)
+                    section = Section(key, heading, items, section_te, digest=digest)
+
+                if self.section_cache is not None:
+                    self.section_cache[(filename, key)] = section
+                sections.append(section)
+
+        with self.profiler.phase('analytics'):
+            hours = self.hours_breakdown(time_entries)
+
+        context = dict(sections=sections,
+                       hours=hours,
+                       week_number=week_number,
+                       developer=developer)
+        if 'csv' in self.formats:
+            context['time_entries'] = time_entries
+
+        return filename, context
+
+
+    def hours_breakdown(self, time_entries):
+        """
+        Summarizes where the hours of the given time entries went.
+        :param time_entries: List of TimeEntry objects.
+        :return: A dictionary with the total hours, lists of (label, hours)
+                 rows per issue, project and tag sorted by hours, the
+                 (weekday, hours) rows of the days worked, and the
+                 (monday, hours, delta) rows of the weeks.
+        """
+        analytics = HoursAnalytics(time_entries, self.tag_matcher.tags, lambda te: self.parse_comments(te)[1])
+
+        def by_hours(rows):
+            return sorted(rows, key=lambda row: -row[1])
+
+        issues = [(self.fetch_issue(issue_id).subject if issue_id else u'(no issue)', hours)
+                  for issue_id, hours in analytics.by_issue().items()]
+        projects = [(analytics.project_names.get(project_id) or self.fetch_project(project_id).name, hours)
+                    for project_id, hours in analytics.by_project().items()]
+        tags = [(tag, hours) for tag, hours in analytics.by_tag().items() if hours]
+
+        return dict(total=analytics.total,
+                    issues=by_hours(issues),
+                    projects=by_hours(projects),
+                    tags=by_hours(tags),
+                    weekdays=[(name, hours) for name, hours in zip(WEEKDAY_NAMES, analytics.by_weekday()) if hours],
+                    weeks=analytics.by_week())
+
+    def section_digest(self, key, time_entries):
+        """
+        Computes a hash of everything a report section is built from: its
+        time entries and the issues they belong to.
+        :param key: Key of the section.
+        :param time_entries: List of the TimeEntry objects of the section.
+        :return: The hexadecimal digest.
+        """
+        digest = hashlib.sha1(key)
+        for te in time_entries:
+            digest.update(repr((te.id, te.issue_id, te.project_id, te.project_name, te.hours, te.comments)))
+            if te.issue_id is not None:
+                issue = self.fetch_issue(te.issue_id)
+                digest.update(repr((issue.subject, issue.done_ratio, unicode(issue.status),
+                                    issue.project.id, issue.project.name)))
+        return digest.hexdigest()
 
 
 class Config(object):
@@ -382,24 +1216,25 @@ class Config(object):
 
     def update_config_file(self):
         '''
-        Writes the current configuration to the config file and then reloads
-        it.
+        Writes the current configuration to the config file.
         '''
 
         with open(self.config_file_name, 'wb') as configfile:
             self.conf.write(configfile)
-        self.reload_config_file()
 
     def put_value(self, option, value, section='GENERAL'):
         """
-        Saves the given option-value pair to the config file.
+        Saves the given option-value pair to the config file. The file is
+        only written if the value changed.
         :param option: Key name to save the value under.
         :param value: The value to save.
         :param section: Section name to save the value under. Defaults to
                         GENERAL
         :return: None
         """
-        self.reload_config_file()
+        if self.get_value(option, section) == value:
+            return
+
         if not self.conf.has_section(section):
             self.conf.add_section(section)
         self.conf.set(section, option, value)
@@ -420,19 +1255,669 @@ class Config(object):
         else:
             return None
 
+    def get_bool(self, option, section='GENERAL'):
+        """
+        Retrieves the given option as a boolean. Returns False if the option
+        does not exist.
+
+        :param option: Key name to retrieve from the config file.
+        :param section: Section to search under. Defaults to GENERAL
+        :return: True if the value is 1, yes, true or on, False otherwise.
+        """
+        value = self.get_value(option, section)
+        return value is not None and value.strip().lower() in ('1', 'yes', 'true', 'on')
+
     def items(self, section):
         return self.conf.items(section)
 
 
+class Profiler(object):
+    """
+    Collects the time spent in each phase of a run and counters such as HTTP
+    requests per resource type and cache hits and misses. Phases may run
+    several times, in several threads, or nested in each other; each run is
+    recorded in the trace.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager timing the enclosed block as the given phase.
+        :param name: Name of the phase.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                calls, total = self.phases.get(name, (0, 0.0))
+                self.phases[name] = (calls + 1, total + duration)
+                self.events.append({'phase': name,
+                                    'thread': threading.current_thread().name,
+                                    'start': start - self.started,
+                                    'duration': duration})
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self):
+        """
+        Formats the phase timings and counters collected.
+        :return: A multi-line string.
+        """
+        lines = ['{:<20} {:>6} {:>10}'.format('Phase', 'Calls', 'Time (s)')]
+        for name, (calls, total) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+            lines.append('{:<20} {:>6} {:>10.3f}'.format(name, calls, total))
+        lines.append('{:<20} {:>6} {:>10.3f}'.format('total', '', time.time() - self.started))
+        lines.append('')
+        for name, value in sorted(self.counters.items()):
+            lines.append('{:<34} {:>8}'.format(name, value))
+        return '\n'.join(lines)
+
+    def write_trace(self, filename):
+        """
+        Writes the phase runs and counters collected to a JSON file.
+        :param filename: Name of the file to write.
+        :return: None
+        """
+        with open(filename, 'w') as f:
+            json.dump({'total': time.time() - self.started,
+                       'phases': dict((name, {'calls': calls, 'time': total})
+                                      for name, (calls, total) in self.phases.items()),
+                       'counters': self.counters,
+                       'events': self.events}, f, indent=2)
+
+
+class RateLimiter(object):
+    """
+    Spaces out requests so that no more than rate of them start per second,
+    across all threads. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        """
+        Blocks until the next request is allowed to start.
+        :return: None
+        """
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CurrentUser(object):
+    """
+    The user running the report, as much of it as the report needs.
+    """
+
+    def __init__(self, id, firstname, lastname):
+        self.id = id
+        self.firstname = firstname
+        self.lastname = lastname
+
+    def __unicode__(self):
+        return u'{} {}'.format(self.firstname, self.lastname)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class PooledRedmineMixin(object):
+    """
+    Redmine client behaviour sending the requests through a shared session
+    with a connection pool and keep-alive, retrying failed requests with
+    exponential backoff and jitter, and optionally limiting the global
+    request rate. Combined with python-redmine's Redmine class by
+    make_redmine.
+
+    Connection errors, timeouts and 5xx responses are retried up to retries
+    times, waiting about backoff * 2^attempt seconds between attempts.
+    """
+
+    def __init__(self, url, pool_size=1, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, rate_limit=0,
+                 profiler=None, **kwargs):
+        super(PooledRedmineMixin, self).__init__(url, **kwargs)
+        self.profiler = profiler or Profiler()
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = RateLimiter(rate_limit)
+        install_session(make_session(pool_size))
+
+    def request(self, method, url, *args, **kwargs):
+        from redmine import exceptions as rm_exceptions
+        from requests import exceptions as req_exceptions
+
+        resource = url[len(self.url):].strip('/').split('/')[0].split('.')[0]
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            self.profiler.count('http.{}.{}'.format(method, resource))
+            try:
+                return super(PooledRedmineMixin, self).request(method, url, *args, **kwargs)
+            except (req_exceptions.ConnectionError, req_exceptions.Timeout,
+                    rm_exceptions.ServerError, rm_exceptions.UnknownError) as e:
+                if attempt >= self.retries or not is_retryable(e):
+                    raise
+
+            time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+
+
+class ResourceCache(object):
+    """
+    Persistent cache of Redmine resources backed by a SQLite database.
+    Entries are keyed by resource name and ID. Changes are saved by commit,
+    which also evicts the least recently used resources beyond max_entries
+    and the oldest time entries beyond max_entries.
+    """
+
+    def __init__(self, filename, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS resources ('
+                         'name TEXT, id INTEGER, updated_on TEXT, last_used REAL, data TEXT, '
+                         'PRIMARY KEY (name, id))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS time_entries ('
+                         'id INTEGER PRIMARY KEY, user_id INTEGER, spent_on TEXT, data TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS time_entries_user_spent_on '
+                         'ON time_entries (user_id, spent_on)')
+        self._db.commit()
+
+    def get(self, name, id):
+        """
+        Retrieves the attributes of a cached resource and marks it as used.
+        :param name: Name of the resource. May be issue or project.
+        :param id: ID of the resource.
+        :return: Dictionary of the resource attributes, or None if the resource
+                 is not cached.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT data FROM resources WHERE name = ? AND id = ?',
+                                   (name, id)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE resources SET last_used = ? WHERE name = ? AND id = ?',
+                             (time.time(), name, id))
+        return json.loads(row[0])
+
+    def put(self, name, resource):
+        """
+        Adds or replaces a resource in the cache.
+        :param name: Name of the resource. May be issue or project.
+        :param resource: The redmine resource instance to store.
+        :return: None
+        """
+        attributes = resource_attributes(resource)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?)',
+                             (name, resource.id, attributes.get('updated_on'), time.time(),
+                              json.dumps(attributes)))
+
+    def get_all(self, name):
+        """
+        Retrieves the attributes of all the cached resources of the given
+        type.
+        :param name: Name of the resource. May be issue or project.
+        :return: A list of dictionaries of resource attributes.
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT data FROM resources WHERE name = ?', (name,)).fetchall()
+            self._db.execute('UPDATE resources SET last_used = ? WHERE name = ?', (time.time(), name))
+        return [json.loads(row[0]) for row in rows]
+
+    def ids(self, name):
+        """
+        Lists the IDs of the cached resources of the given type.
+        :param name: Name of the resource. May be issue or project.
+        :return: A list of IDs.
+        """
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT id FROM resources WHERE name = ?', (name,))]
+
+    def clear(self, name=None):
+        """
+        Removes all cached resources of the given type, or everything if no
+        type is given.
+        :param name: Optional name of the resource. May be issue or project.
+        :return: None
+        """
+        with self._lock:
+            if name is None:
+                self._db.execute('DELETE FROM resources')
+                self._db.execute('DELETE FROM meta')
+                self._db.execute('DELETE FROM time_entries')
+            else:
+                self._db.execute('DELETE FROM resources WHERE name = ?', (name,))
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def put_time_entry(self, attributes):
+        """
+        Adds or replaces a time entry in the time entry store.
+        :param attributes: Dictionary of time entry attributes, as returned by
+                           the Redmine API.
+        :return: None
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO time_entries VALUES (?, ?, ?, ?)',
+                             (attributes['id'], attributes['user']['id'], attributes['spent_on'],
+                              json.dumps(attributes)))
+
+    def replace_time_entries(self, user_id, startdate, enddate, time_entries):
+        """
+        Replaces all stored time entries of a user within the given date
+        range. Entries stored before but missing from time_entries are
+        considered deleted. The replacement is saved as a single transaction.
+        :param user_id: ID of the user the entries belong to.
+        :param startdate: Start date of the range.
+        :param enddate: End date of the range.
+        :param time_entries: Iterable of time entry attribute dictionaries.
+        :return: None
+        """
+        rows = [(te['id'], te['user']['id'], te['spent_on'], json.dumps(te)) for te in time_entries]
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM time_entries WHERE user_id = ? AND spent_on BETWEEN ? AND ?',
+                             (user_id, str(startdate), str(enddate)))
+            self._db.executemany('INSERT OR REPLACE INTO time_entries VALUES (?, ?, ?, ?)', rows)
+
+    def time_entries(self, user_id, startdate, enddate):
+        """
+        Retrieves the stored time entries of a user within the given date
+        range.
+        :param user_id: ID of the user the entries belong to.
+        :param startdate: Start date of the range.
+        :param enddate: End date of the range.
+        :return: A list of dictionaries of time entry attributes.
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT data FROM time_entries '
+                                    'WHERE user_id = ? AND spent_on BETWEEN ? AND ? ORDER BY spent_on, id',
+                                    (user_id, str(startdate), str(enddate))).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def count_time_entries(self, user_id, startdate, enddate):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM time_entries '
+                                    'WHERE user_id = ? AND spent_on BETWEEN ? AND ?',
+                                    (user_id, str(startdate), str(enddate))).fetchone()[0]
+
+    def covers(self, user_id, startdate, enddate):
+        """
+        Checks whether all the time entries of a user within the given date
+        range have been stored already.
+        :param user_id: ID of the user the entries belong to.
+        :param startdate: Start date of the range.
+        :param enddate: End date of the range.
+        :return: True if the range was stored before, False otherwise.
+        """
+        ranges = json.loads(self.get_meta('time_entry_coverage:{}'.format(user_id)) or '[]')
+        return any(start <= str(startdate) and str(enddate) <= end for start, end in ranges)
+
+    def add_coverage(self, user_id, startdate, enddate):
+        """
+        Records that all the time entries of a user within the given date
+        range have been stored. The range is merged with the overlapping and
+        adjacent ones, so a request spanning several stored ranges is covered.
+        :param user_id: ID of the user the entries belong to.
+        :param startdate: Start date of the range.
+        :param enddate: End date of the range.
+        :return: None
+        """
+        key = 'time_entry_coverage:{}'.format(user_id)
+        ranges = sorted(json.loads(self.get_meta(key) or '[]') + [[str(startdate), str(enddate)]])
+        merged = []
+        for start, end in ranges:
+            if merged and parse_date(start) <= parse_date(merged[-1][1]) + datetime.timedelta(days=1):
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.set_meta(key, json.dumps(merged))
+
+    def commit(self):
+        """
+        Evicts the least recently used resources beyond max_entries and the
+        time entries of the oldest days beyond max_entries, then saves the
+        changes. The coverage of the evicted days is dropped, so they are
+        fetched again when requested.
+        :return: None
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM resources WHERE rowid IN '
+                             '(SELECT rowid FROM resources ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                             (self.max_entries,))
+            row = self._db.execute('SELECT spent_on FROM time_entries ORDER BY spent_on DESC LIMIT 1 OFFSET ?',
+                                   (self.max_entries,)).fetchone()
+            if row is not None:
+                self._evict_time_entries(row[0])
+            self._db.commit()
+
+    def _evict_time_entries(self, last_evicted):
+        """
+        Removes the time entries spent on or before the given day, and that
+        day and the ones before it from the coverage of every user.
+        :param last_evicted: The last day evicted, in YYYY-MM-DD format.
+        :return: None
+        """
+        first_kept = str(parse_date(last_evicted) + datetime.timedelta(days=1))
+        self._db.execute('DELETE FROM time_entries WHERE spent_on <= ?', (last_evicted,))
+        rows = self._db.execute("SELECT key, value FROM meta WHERE key LIKE 'time_entry_coverage:%'").fetchall()
+        for key, value in rows:
+            ranges = [[max(start, first_kept), end] for start, end in json.loads(value) if end >= first_kept]
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(ranges)))
+
+    def close(self):
+        """
+        Saves the changes and closes the database.
+        :return: None
+        """
+        self.commit()
+        with self._lock:
+            self._db.close()
+
+
+class TimeEntry(object):
+    """
+    Compact record of the fields of a Redmine time entry used by the report.
+    Holding these instead of the full python-redmine resources keeps team and
+    quarter sized runs small in memory.
+    """
+    __slots__ = ('id', 'issue_id', 'project_id', 'project_name', 'user_id', 'user_name', 'hours', 'spent_on',
+                 'comments')
+
+    def __init__(self, id, issue_id, project_id, project_name, user_id, user_name, hours, spent_on, comments):
+        self.id = id
+        self.issue_id = issue_id
+        self.project_id = project_id
+        self.project_name = project_name
+        self.user_id = user_id
+        self.user_name = user_name
+        self.hours = hours
+        self.spent_on = spent_on
+        self.comments = comments
+
+    @classmethod
+    def from_attributes(cls, attributes):
+        """
+        Projects the raw attributes of a time entry, as returned by the
+        Redmine API, into a TimeEntry.
+        :param attributes: Dictionary of time entry attributes.
+        :return: The TimeEntry instance created.
+        """
+        year, month, day = attributes['spent_on'].split('-')
+        return cls(attributes['id'],
+                   attributes.get('issue', {}).get('id'),
+                   attributes['project']['id'],
+                   attributes['project'].get('name'),
+                   attributes['user']['id'],
+                   attributes['user'].get('name'),
+                   float(attributes['hours']),
+                   datetime.date(int(year), int(month), int(day)),
+                   attributes.get('comments') or u'')
+
+    def to_attributes(self):
+        """
+        Converts the time entry back into Redmine API attributes, as read by
+        from_attributes.
+        :return: Dictionary of time entry attributes.
+        """
+        attributes = {'id': self.id,
+                      'project': {'id': self.project_id, 'name': self.project_name},
+                      'user': {'id': self.user_id, 'name': self.user_name},
+                      'hours': self.hours,
+                      'spent_on': str(self.spent_on),
+                      'comments': self.comments}
+        if self.issue_id is not None:
+            attributes['issue'] = {'id': self.issue_id}
+        return attributes
+
+
+class HoursAnalytics(object):
+    """
+    Breakdown of the hours of a set of time entries per issue, project, tag,
+    weekday and week. The entries are loaded once into columns of typed
+    arrays: hours, day ordinal, issue ID (0 for none) and project ID. Tags
+    are kept apart as (row, tag index) pairs in two parallel columns, one
+    pair per tag found in the comments of an entry. The group-bys run over
+    whole columns with NumPy when it is installed, and fall back to a single
+    pass over the arrays otherwise.
+    """
+
+    def __init__(self, time_entries, tags, tags_of):
+        """
+        :param time_entries: Iterable of TimeEntry objects.
+        :param tags: List of the known tags.
+        :param tags_of: Function returning the set of tags of a time entry.
+        """
+        self.tags = list(tags)
+        indexes = dict((tag, i) for i, tag in enumerate(self.tags))
+
+        self.hours = array.array('d')
+        self.days = array.array('l')
+        self.issue_ids = array.array('l')
+        self.project_ids = array.array('l')
+        self.tag_rows = array.array('l')
+        self.tag_indexes = array.array('l')
+        self.project_names = {}
+
+        for row, te in enumerate(time_entries):
+            for tag in tags_of(te):
+                if tag in indexes:
+                    self.tag_rows.append(row)
+                    self.tag_indexes.append(indexes[tag])
+            self.hours.append(te.hours)
+            self.days.append(te.spent_on.toordinal())
+            self.issue_ids.append(te.issue_id or 0)
+            self.project_ids.append(te.project_id)
+            self.project_names.setdefault(te.project_id, te.project_name)
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self._np = numpy
+
+    def column(self, values):
+        """
+        Wraps a column in a NumPy array sharing its memory, when NumPy is
+        available.
+        :param values: One of the array.array columns, or a NumPy array.
+        :return: The NumPy array, or the column itself.
+        """
+        if self._np is None or not isinstance(values, array.array):
+            return values
+        return self._np.frombuffer(values, dtype=values.typecode)
+
+    @property
+    def total(self):
+        return sum(self.hours)
+
+    def group_sum(self, keys):
+        """
+        Adds up the hours of each distinct key.
+        :param keys: A column with one key per time entry, or a NumPy array
+                     computed from columns.
+        :return: A dictionary of the hours per key.
+        """
+        if self._np is None:
+            totals = {}
+            for key, hours in itertools.izip(keys, self.hours):
+                totals[key] = totals.get(key, 0.0) + hours
+            return totals
+
+        unique, inverse = self._np.unique(self.column(keys), return_inverse=True)
+        sums = self._np.bincount(inverse, weights=self.column(self.hours))
+        return dict(itertools.izip(unique.tolist(), sums.tolist()))
+
+    def by_issue(self):
+        return self.group_sum(self.issue_ids)
+
+    def by_project(self):
+        return self.group_sum(self.project_ids)
+
+    def by_tag(self):
+        """
+        :return: A dictionary of the hours per tag. An entry with several tags
+                 counts towards each of them.
+        """
+        if self._np is None:
+            totals = [0.0] * len(self.tags)
+            for row, i in itertools.izip(self.tag_rows, self.tag_indexes):
+                totals[i] += self.hours[row]
+        else:
+            hours = self.column(self.hours)[self.column(self.tag_rows)]
+            totals = self._np.bincount(self.column(self.tag_indexes), weights=hours,
+                                       minlength=len(self.tags)).tolist()
+        return dict(itertools.izip(self.tags, totals))
+
+    def by_weekday(self):
+        """
+        :return: A list of seven hour totals, Monday first.
+        """
+        if self._np is None:
+            totals = [0.0] * 7
+            for day, hours in itertools.izip(self.days, self.hours):
+                totals[(day - 1) % 7] += hours
+            return totals
+
+        weekdays = (self.column(self.days) - 1) % 7
+        return self._np.bincount(weekdays, weights=self.column(self.hours), minlength=7).tolist()
+
+    def by_week(self):
+        """
+        :return: A list of (monday, hours, delta) tuples, one per week with
+                 hours, in order. The delta is the change from the previous
+                 week listed, or None for the first one.
+        """
+        if self._np is None:
+            weeks = array.array('l', ((day - 1) // 7 for day in self.days))
+        else:
+            weeks = (self.column(self.days) - 1) // 7
+
+        rows, previous = [], None
+        for week, hours in sorted(self.group_sum(weeks).items()):
+            rows.append((datetime.date.fromordinal(week * 7 + 1), hours,
+                         None if previous is None else hours - previous))
+            previous = hours
+        return rows
+
+
+class TagMatcher(object):
+    """
+    Finds known tags in time entry comments. Built once from the values of
+    the [TAGS] section, where each value is a tag optionally followed by
+    comma separated aliases, e.g. "help, blocked, stuck".
+    """
+
+    def __init__(self, tags):
+        self.tags = []
+        self.aliases = {}
+        for value in tags:
+            names = [name.strip().lower() for name in value.split(',') if name.strip()]
+            if names and names[0] not in self.tags:
+                self.tags.append(names[0])
+            for name in names:
+                self.aliases[name] = names[0]
+
+        self._regex = re.compile(r'#(\w+)', re.UNICODE)
+
+    def parse(self, text):
+        """
+        Scans the text once, removing and collecting the known tags. Other
+        hashtags, such as issue references, are left in the text.
+        :param text: Text to search for tags.
+        :return: A tuple (text, tags) with the text stripped of known tags and
+                 the set of known tags found, aliases resolved to their tag.
+        """
+        tags = set()
+
+        def strip(match):
+            tag = self.aliases.get(match.group(1).lower())
+            if not tag:
+                return match.group(0)
+            tags.add(tag)
+            return ''
+
+        return self._regex.sub(strip, text).strip(), tags
+
+
+class Section(object):
+    """
+    A report section as consumed by the templating engine: its heading, its
+    Presentable items and the number and hours of the time entries in it.
+    Flat sections list only the titles of their items. The digest identifies
+    the inputs the section was built from, when tracked.
+    """
+
+    def __init__(self, key, heading, items, time_entries, flat=False, digest=None):
+        self.key = key
+        self.heading = heading
+        self.items = items
+        self.flat = flat
+        self.count = len(time_entries)
+        self.hours = sum(te.hours for te in time_entries)
+        self.digest = digest
+
+
+class Subitem(object):
+    """
+    A sub-item of a Presentable: its text, how many times it was added and
+    the hours logged against it.
+    """
+    __slots__ = ('text', 'count', 'hours')
+
+    def __init__(self, text):
+        self.text = text
+        self.count = 0
+        self.hours = 0.0
+
+
 class Presentable(object):
     """
     Represents an item and its corresponding sub-items to be
     consumed by the templating engine.
+
+    Sub-items are deduplicated on a normalized key. Adding a duplicate
+    increases the count and hours of the existing sub-item instead. In
+    fuzzy mode the key ignores case, punctuation, digits and spacing, so
+    near-duplicate comments collapse as well. Comments without any letter
+    keep the strict key, so they are not all merged into one.
     """
+    __slots__ = ('_title', '_subitems', '_index', 'fuzzy')
 
-    def __init__(self, title=None):
+    def __init__(self, title=None, fuzzy=False):
         self._subitems = []
+        self._index = {}
         self._title = title
+        self.fuzzy = fuzzy
 
     @property
     def title(self):
@@ -446,15 +1931,593 @@ class Presentable(object):
     def subitems(self):
         return self._subitems
 
-    def add_subitem(self, subitem):
-        subitem = subitem
-        if self.normalize(subitem) not in [self.normalize(el) for el in self._subitems]:
-            self._subitems.append(subitem)
+    def add_subitem(self, subitem, hours=0.0):
+        key = self.normalize(subitem)
+        item = self._index.get(key)
+        if item is None:
+            item = Subitem(subitem)
+            self._index[key] = item
+            self._subitems.append(item)
+        item.count += 1
+        item.hours += hours
 
     def normalize(self, s):
+        if self.fuzzy:
+            key = u' '.join(FUZZY_WORD_REGEX.findall(s.lower()))
+            if key:
+                return key
         return s.strip().lower()
 
 
+def chunk_ids(ids, max_chars=MAX_ID_LIST_CHARS, max_len=MAX_PAGE_LIMIT):
+    """
+    Splits a list of IDs into chunks suitable for a single filter request.
+    Each chunk holds at most max_len IDs and its comma separated form is at
+    most max_chars long.
+    :param ids: List of IDs to split.
+    :param max_chars: Maximum length of the comma separated IDs of a chunk.
+    :param max_len: Maximum number of IDs in a chunk.
+    :return: A generator of lists of IDs.
+    """
+    chunk = []
+    chunk_chars = 0
+    for id in ids:
+        id_chars = len(str(id)) + 1
+        if chunk and (len(chunk) >= max_len or chunk_chars + id_chars > max_chars):
+            yield chunk
+            chunk = []
+            chunk_chars = 0
+        chunk.append(id)
+        chunk_chars += id_chars
+
+    if chunk:
+        yield chunk
+
+
+def total_count(resource_set):
+    """
+    Retrieves the number of resources the server holds for a query.
+    python-redmine only knows the count once the set has been evaluated, so
+    the set is evaluated first.
+    :param resource_set: A ResourceSet, usually filtered with limit=1.
+    :return: The total count reported by the server.
+    """
+    len(resource_set)
+    return resource_set.total_count
+
+
+def resource_attributes(resource):
+    """
+    Retrieves the raw attributes of a python-redmine resource, as returned
+    by the Redmine API. python-redmine 1.x keeps them in the private
+    _attributes dictionary and offers no public accessor.
+    :param resource: The redmine resource instance.
+    :return: A copy of the dictionary of attributes.
+    """
+    return dict(resource._attributes)
+
+
+_redmine_class = None
+
+
+def make_redmine(url, **kwargs):
+    """
+    Creates a Redmine client with the PooledRedmineMixin behaviour. This is
+    where python-redmine and requests get imported.
+    :param url: URL of the Redmine server.
+    :param kwargs: Arguments of PooledRedmineMixin and of python-redmine's
+                   Redmine class.
+    :return: The Redmine client created.
+    """
+    global _redmine_class
+    if _redmine_class is None:
+        import requests.packages.urllib3
+        from redmine import Redmine
+
+        requests.packages.urllib3.disable_warnings()
+        _redmine_class = type('PooledRedmine', (PooledRedmineMixin, Redmine), {})
+
+    return _redmine_class(url, **kwargs)
+
+
+def make_session(pool_size):
+    """
+    Creates an HTTP session keeping up to pool_size connections alive to the
+    server, one per worker thread, and accepting compressed responses.
+    :param pool_size: Maximum number of connections kept in the pool.
+    :return: The requests.Session instance created.
+    """
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def install_session(session):
+    """
+    Makes python-redmine send its requests through the given session.
+    python-redmine calls the functions of the requests module directly and
+    offers no way to pass a session, so the module reference it uses is
+    replaced with the session, which has the same request methods.
+    :param session: The requests.Session instance to use.
+    :return: None
+    """
+    from redmine import Redmine
+
+    sys.modules[Redmine.__module__].requests = session
+
+
+def is_retryable(error):
+    """
+    Tells whether a failed request may succeed if sent again.
+    :param error: The exception raised by the request.
+    :return: True for connection errors, timeouts and 5xx responses.
+    """
+    from redmine import exceptions as rm_exceptions
+    from requests import exceptions as req_exceptions
+
+    if isinstance(error, (req_exceptions.ConnectionError, req_exceptions.Timeout, rm_exceptions.ServerError)):
+        return True
+    if isinstance(error, rm_exceptions.UnknownError):
+        # python-redmine keeps the status code of other errors only in the
+        # message, "Redmine returned unknown error with the code 503".
+        match = STATUS_CODE_REGEX.search(str(error))
+        return match is not None and int(match.group(1)) >= 500
+    return False
+
+
+def id_set(ids):
+    """
+    Turns a single ID or a collection of IDs into a set for O(1) lookups.
+    :param ids: An ID or an iterable of IDs.
+    :return: A set of IDs.
+    """
+    if hasattr(ids, '__iter__'):
+        return set(ids)
+    return set([ids])
+
+
+def load_template():
+    """
+    Loads the report template. The compiled template is kept in the user
+    cache directory under a hash of the template source, so it is compiled
+    only once per version of the template.
+    :return: The mako Template instance.
+    """
+    from mako.template import Template
+
+    with open(TEMPLATE_FILE, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+
+    return Template(filename=TEMPLATE_FILE,
+                    uri='template.htm',
+                    module_directory=os.path.join(USER_CACHE_DIR, 'templates', digest),
+                    default_filters=['decode.utf8'],
+                    input_encoding='utf-8',
+                    output_encoding='utf-8')
+
+
+def render_to_file(template, filename, context):
+    """
+    Renders a template straight into a file through a buffered UTF-8 writer,
+    without building the whole document in memory.
+    :param template: The mako Template instance to render.
+    :param filename: Name of the file to write.
+    :param context: Dictionary of the variables of the template.
+    :return: None
+    """
+    from mako.runtime import Context
+
+    with open(filename, 'wb', RENDER_BUFFER_SIZE) as f:
+        template.render_context(Context(codecs.getwriter('utf-8')(f), **context))
+
+
+def write_snapshot(filename, header, records):
+    """
+    Writes a report snapshot as gzipped JSON lines.
+    :param filename: Name of the file to write.
+    :param header: Dictionary with the format, version and report details.
+    :param records: Iterable of (type, attributes) tuples.
+    :return: None
+    """
+    with contextlib.closing(gzip.open(filename, 'wb')) as f:
+        f.write(json.dumps(header) + '\n')
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def read_snapshot(filename):
+    """
+    Opens a report snapshot. Only the header is read up front; the records
+    are decompressed and parsed one line at a time as they are consumed.
+    :param filename: Name of the snapshot file.
+    :return: A tuple (header, records) with the header dictionary and a
+             generator of (type, attributes) tuples.
+    """
+    f = io.BufferedReader(gzip.open(filename, 'rb'))
+    try:
+        header = json.loads(f.readline() or 'null')
+    except (IOError, ValueError):
+        header = None
+
+    if not isinstance(header, dict) or header.get('format') != SNAPSHOT_FORMAT:
+        f.close()
+        raise ValueError('{} is not a report snapshot.'.format(filename))
+    if header.get('version') > SNAPSHOT_VERSION:
+        f.close()
+        raise ValueError('{} was written by a newer version (snapshot version {}).'.format(filename,
+                                                                                          header.get('version')))
+
+    def records():
+        with contextlib.closing(f):
+            for line in f:
+                resource_name, attributes = json.loads(line)
+                yield resource_name, attributes
+
+    return header, records()
+
+
+_template = None
+_template_lock = threading.Lock()
+
+
+def cached_template():
+    """
+    Loads the report template once per process.
+    :return: The mako Template instance.
+    """
+    global _template
+    with _template_lock:
+        if _template is None:
+            _template = load_template()
+    return _template
+
+
+def plain_text(text):
+    """
+    Removes the HTML markup of report titles for the text based formats.
+    :param text: Text possibly containing HTML tags.
+    :return: The text without tags.
+    """
+    return HTML_TAG_REGEX.sub('', text)
+
+
+def render_html(filename, context):
+    """
+    Renders a report with the HTML template.
+    :param filename: Name of the file to write.
+    :param context: Dictionary of the report variables, as built by
+                    Weekly.build_report.
+    :return: None
+    """
+    render_to_file(cached_template(), filename, context)
+
+
+def render_markdown(filename, context):
+    """
+    Renders a report as Markdown, e.g. for the body of an email.
+    :param filename: Name of the file to write.
+    :param context: Dictionary of the report variables, as built by
+                    Weekly.build_report.
+    :return: None
+    """
+    hours = context['hours']
+    with open(filename, 'wb', RENDER_BUFFER_SIZE) as f:
+        out = codecs.getwriter('utf-8')(f)
+        out.write(u'# Weekly Report {}\n\nDeveloper: {}\n'.format(context['week_number'],
+                                                                 unicode(context['developer'])))
+        for section in context['sections']:
+            out.write(u'\n## {}\n\n'.format(section.heading))
+            for item in section.items:
+                out.write(u'- {}\n'.format(plain_text(item.title)))
+                if not section.flat:
+                    for subitem in item.subitems:
+                        count = u' (x{})'.format(subitem.count) if subitem.count > 1 else u''
+                        out.write(u'    - {}{}\n'.format(subitem.text, count))
+
+        out.write(u'\n## Time Spent: {:.2f}h\n'.format(hours['total']))
+        for title, rows in (('Project', hours['projects']), ('Issue', hours['issues']),
+                            ('Tag', [('#' + tag, spent) for tag, spent in hours['tags']]),
+                            ('Day', hours['weekdays'])):
+            if rows:
+                out.write(u'\n| {} | Hours |\n| --- | ---: |\n'.format(title))
+                for label, spent in rows:
+                    out.write(u'| {} | {:.2f} |\n'.format(label, spent))
+        if len(hours['weeks']) > 1:
+            out.write(u'\n| Week of | Hours | Change |\n| --- | ---: | ---: |\n')
+            for monday, spent, delta in hours['weeks']:
+                out.write(u'| {} | {:.2f} | {} |\n'.format(monday, spent, u'' if delta is None else
+                                                           u'{:+.2f}'.format(delta)))
+
+
+def render_csv(filename, context):
+    """
+    Renders the time entries of a report as CSV, one row per entry, for
+    timesheet systems.
+    :param filename: Name of the file to write.
+    :param context: Dictionary of the report variables, as built by
+                    Weekly.build_report with the time entries included.
+    :return: None
+    """
+    with open(filename, 'wb', RENDER_BUFFER_SIZE) as f:
+        writer = csv.writer(f)
+        writer.writerow(['date', 'user', 'project', 'issue', 'hours', 'comments'])
+        for te in context['time_entries']:
+            writer.writerow([te.spent_on, (te.user_name or u'').encode('utf-8'),
+                             (te.project_name or u'').encode('utf-8'), te.issue_id or '', te.hours,
+                             te.comments.encode('utf-8')])
+
+
+def render_json(filename, context):
+    """
+    Renders the sections and the hours breakdown of a report as JSON, e.g.
+    for dashboards. The document is encoded and written piece by piece.
+    :param filename: Name of the file to write.
+    :param context: Dictionary of the report variables, as built by
+                    Weekly.build_report.
+    :return: None
+    """
+    document = {'week_number': context['week_number'],
+                'developer': unicode(context['developer']),
+                'sections': [{'key': section.key,
+                              'heading': section.heading,
+                              'count': section.count,
+                              'hours': section.hours,
+                              'items': [{'title': plain_text(item.title),
+                                         'subitems': [{'text': subitem.text,
+                                                       'count': subitem.count,
+                                                       'hours': subitem.hours}
+                                                      for subitem in item.subitems]}
+                                        for item in section.items]}
+                             for section in context['sections']],
+                'hours': context['hours']}
+
+    with open(filename, 'wb', RENDER_BUFFER_SIZE) as f:
+        for chunk in json.JSONEncoder(indent=2, sort_keys=True, default=str).iterencode(document):
+            f.write(chunk)
+
+
+# Output formats selectable with --format: file extension, content type and
+# renderer of each.
+RENDERERS = {'html': ('.html', 'text/html; charset=utf-8', render_html),
+             'md': ('.md', 'text/markdown; charset=utf-8', render_markdown),
+             'csv': ('.csv', 'text/csv; charset=utf-8', render_csv),
+             'json': ('.json', 'application/json', render_json)}
+
+
+def output_filename(filename, fmt):
+    """
+    Computes the name of the file of a report in the given format.
+    :param filename: Name of the report as returned by Weekly.build_report.
+    :param fmt: Key of the format in RENDERERS.
+    :return: The filename with the extension of the format.
+    """
+    return os.path.splitext(filename)[0] + RENDERERS[fmt][0]
+
+
+def render_outputs(filename, context, formats):
+    """
+    Renders a report in each of the given formats. Every format streams to
+    its own file, and several formats are rendered concurrently from the
+    same context.
+    :param filename: Name of the report as returned by Weekly.build_report.
+    :param context: Dictionary of the report variables.
+    :param formats: List of keys of RENDERERS.
+    :return: The list of the files written, in the order of formats.
+    """
+    jobs = [(output_filename(filename, fmt), RENDERERS[fmt][2]) for fmt in formats]
+    if len(jobs) == 1:
+        jobs[0][1](jobs[0][0], context)
+    else:
+        pool = ThreadPool(len(jobs))
+        try:
+            pool.map(lambda job: job[1](job[0], context), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [output for output, renderer in jobs]
+
+
+def render_report(job):
+    """
+    Renders a report in the requested formats. Meant to run in a worker
+    process, so the template is compiled once per process.
+    :param job: A tuple (report, formats) where report is a tuple
+                (filename, context) as returned by Weekly.build_report.
+    :return: The list of the files written.
+    """
+    (filename, context), formats = job
+    return render_outputs(filename, context, formats)
+
+
+class ReportRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers GET / with the report of the week and GET /refresh with a JSON
+    summary, bringing the report up to date first in both cases.
+    """
+
+    def do_GET(self):
+        from requests import exceptions as req_exceptions
+
+        path = self.path.split('?')[0]
+        if path not in ('/', '/refresh'):
+            return self.reply(404, 'text/plain', 'Not found.')
+
+        try:
+            with self.server.lock:
+                filename, changed = self.server.weekly.refresh_week()
+        except (req_exceptions.ConnectionError, req_exceptions.Timeout):
+            return self.reply(503, 'text/plain', 'Connection error. Please try again later.')
+
+        if path == '/refresh':
+            return self.reply(200, 'application/json', json.dumps({'filename': filename, 'changed': changed}))
+
+        content_type = [r[1] for r in RENDERERS.values() if filename.endswith(r[0])][0]
+        with open(filename, 'rb') as f:
+            self.reply(200, content_type, f.read())
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_reports(weekly, port, interval=None):
+    """
+    Serves the report of the week on localhost until interrupted, keeping
+    the Weekly instance and its caches alive between requests.
+    :param weekly: A Weekly instance created with incremental=True.
+    :param port: Port to listen on.
+    :param interval: Optional number of seconds between background
+                     refreshes of the report.
+    :return: None
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), ReportRequestHandler)
+    server.weekly = weekly
+    server.lock = threading.Lock()
+
+    if interval:
+        poller = threading.Thread(target=weekly.watch, args=(interval, server.lock))
+        poller.daemon = True
+        poller.start()
+
+    print 'Serving the report on http://localhost:{}/ (refresh with /refresh).'.format(server.server_address[1])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def get_group_user_ids(redmine, group_id):
+    """
+    Retrieves the IDs of the members of a Redmine group.
+    :param redmine: The Redmine instance to query.
+    :param group_id: ID of the group.
+    :return: A list of user IDs.
+    """
+    group = redmine.group.get(group_id, include='users')
+    return [user.id for user in group.users]
+
+
+def week_windows(startdate, enddate):
+    """
+    Splits a date range into ISO week windows. The first and last windows are
+    clipped to the range.
+    :param startdate: Start date of the range.
+    :param enddate: End date of the range.
+    :return: A list of (startdate, enddate) tuples, one per week.
+    """
+    windows = []
+    start = startdate
+    while start <= enddate:
+        end = min(start + datetime.timedelta(days=7 - start.isoweekday()), enddate)
+        windows.append((start, end))
+        start = end + datetime.timedelta(days=1)
+
+    return windows
+
+
+def parse_date(text):
+    """
+    Parses a date given on the command line.
+    :param text: Date in YYYY-MM-DD format.
+    :return: The datetime.date instance parsed.
+    """
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def parse_formats(text):
+    """
+    Parses the comma separated output formats given on the command line.
+    :param text: Format names, e.g. "html,md".
+    :return: The list of format names, without repetitions.
+    """
+    formats = []
+    for fmt in text.lower().split(','):
+        fmt = fmt.strip()
+        if fmt not in RENDERERS:
+            raise argparse.ArgumentTypeError('unknown format "{}", choose from {}'.format(
+                fmt, ', '.join(sorted(RENDERERS))))
+        if fmt not in formats:
+            formats.append(fmt)
+    return formats
+
+
+def make_arg_parser():
+    """
+    Builds the parser of the command line arguments.
+    :return: The argparse.ArgumentParser instance.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--last-week', action='store_true', help='Retrieve report from last week.')
+    parser.add_argument('--from', dest='from_date', type=parse_date,
+                        help='Start date (YYYY-MM-DD) of a range to report, one report per week.')
+    parser.add_argument('--to', dest='to_date', type=parse_date,
+                        help='End date (YYYY-MM-DD) of the range to report. Defaults to today.')
+    parser.add_argument('--weeks', type=int, help='Report the last N weeks, one report per week.')
+    parser.add_argument('--combined', action='store_true',
+                        help='Generate a single report for the whole range instead of one per week.')
+    parser.add_argument('--team', type=lambda s: [int(i) for i in s.split(',')],
+                        help='Comma separated IDs of the users to generate reports for.')
+    parser.add_argument('--group', type=int, help='ID of a Redmine group to generate reports for.')
+    parser.add_argument('-w', '--workers', type=int, help='Number of concurrent requests to Redmine.')
+    parser.add_argument('--page-size', type=int,
+                        help='Number of time entries per request, up to {}.'.format(MAX_PAGE_LIMIT))
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the persistent issue and project cache.')
+    parser.add_argument('--refresh', action='store_true', help='Empty the persistent cache before the report.')
+    parser.add_argument('--profile', nargs='?', const='', metavar='TRACE_FILE',
+                        help='Print where the run spent its time, optionally writing a JSON trace to TRACE_FILE.')
+    parser.add_argument('--offline', action='store_true',
+                        help='Build the report from the local store only, without syncing with Redmine.')
+    parser.add_argument('--format', dest='formats', type=parse_formats, default=['html'],
+                        help='Comma separated output formats, from {}. Defaults to html.'.format(
+                            ', '.join(sorted(RENDERERS))))
+    parser.add_argument('--snapshot', action='store_true',
+                        help='Save the data of each report next to it, to rebuild it later with --from-snapshot.')
+    parser.add_argument('--from-snapshot', metavar='FILE',
+                        help='Rebuild a report from a snapshot saved with --snapshot, without contacting Redmine.')
+    parser.add_argument('--watch', nargs='?', type=int, const=DEFAULT_WATCH_INTERVAL, metavar='SECONDS',
+                        help='Keep running and update the report of the week every SECONDS '
+                             '(default {}).'.format(DEFAULT_WATCH_INTERVAL))
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Keep running and serve the report of the week on localhost:PORT, '
+                             'updating it on every request.')
+    return parser
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments and checks the requested date range
+    and options. Exits with a usage error if they are invalid.
+    :param argv: Optional list of arguments. Defaults to sys.argv.
+    :return: The argparse.Namespace parsed.
+    """
+    parser = make_arg_parser()
+    args = parser.parse_args(argv)
+
+    if args.to_date and not args.from_date:
+        parser.error('--to requires --from')
+    if args.from_date and args.from_date > (args.to_date or datetime.date.today()):
+        parser.error('--from must not be later than --to (or today)')
+    if args.weeks is not None and args.weeks < 1:
+        parser.error('--weeks must be at least 1')
+    if args.offline and args.no_cache:
+        parser.error('--offline requires the persistent cache, it cannot be combined with --no-cache')
+
+    return args
+
+
 def prompt_for_value(key):
     """
     Prompts the user for a value.
@@ -525,41 +2588,122 @@ def transfer_api_key(conf, privconf):
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-l', '--last-week', action='store_true', help='Retrieve report from last week.')
-    args = parser.parse_args()
+    args = parse_args()
 
+    if not os.path.isdir(USER_CONFIG_DIR):
+        os.makedirs(USER_CONFIG_DIR)
     privconf = Config(PRIV_CONF_FILE)
     conf = Config(CONFIG_FILE)
 
     transfer_api_key(conf, privconf)
 
-    api_key = validate_setting(privconf, 'API_KEY')
+    snapshot = None
+    if args.from_snapshot:
+        try:
+            snapshot = read_snapshot(args.from_snapshot)
+        except (IOError, ValueError) as e:
+            print 'Cannot read the snapshot: {}'.format(e)
+            sys.exit(1)
+
+    # Rebuilding a report from a snapshot needs no API key.
+    api_key = validate_setting(privconf, 'API_KEY') if snapshot is None else ''
     main_proj_id = validate_setting(conf, 'MAIN_PROJECT_ID', valtype='int')
     other_tasks_id = validate_setting(conf, 'OTHER_TASKS_ID', valtype='int')
     all_tags = dict(conf.items('TAGS')).values()
     rm_url =  validate_setting(conf, 'REDMINE_URL', valtype='string')
-
-    keep_trying = True
-    while keep_trying:
-        try:
-            weekly = Weekly(args=args,
-                            api_key=api_key,
-                            main_project_id=main_proj_id,
-                            other_tasks_id=other_tasks_id,
-                            tags=all_tags,
-                            rm_url=rm_url)
-
-            rpt_name = weekly.report_week()
-            webbrowser.open(rpt_name)
-            break
-        except rm_exceptions.AuthError:
-            print 'Invalid API KEY. Enter a new value or leave empty to exit.'
-            privconf.put_value('API_KEY', '')
-            api_key = validate_setting(privconf, 'API_KEY')
-            if not api_key:
+    workers = args.workers or int(conf.get_value('WORKERS') or 1)
+    page_size = args.page_size or int(conf.get_value('PAGE_SIZE') or MAX_PAGE_LIMIT)
+    sections = conf.items('SECTIONS') if conf.conf.has_section('SECTIONS') else DEFAULT_SECTIONS
+    timeout = float(conf.get_value('TIMEOUT') or DEFAULT_TIMEOUT)
+    retries = int(conf.get_value('RETRIES') or DEFAULT_RETRIES)
+    rate_limit = float(conf.get_value('RATE_LIMIT') or 0)
+
+    disk_cache = None
+    if not args.no_cache and snapshot is None:
+        disk_cache = ResourceCache(CACHE_FILE, int(conf.get_value('CACHE_SIZE') or DEFAULT_CACHE_SIZE))
+        if args.refresh:
+            disk_cache.clear()
+
+    long_running = bool(args.watch or args.serve is not None)
+    if disk_cache is None and long_running:
+        disk_cache = ResourceCache(':memory:')
+
+    profiler = Profiler()
+
+    from redmine import exceptions as rm_exceptions
+    from requests import exceptions as req_exceptions
+
+    # The persistent cache commits its writes and evicts old entries on
+    # close, so it is closed whatever ends the run.
+    try:
+        keep_trying = True
+        while keep_trying:
+            try:
+                weekly = Weekly(args=args,
+                                api_key=api_key,
+                                main_project_id=main_proj_id,
+                                other_tasks_id=other_tasks_id,
+                                tags=all_tags,
+                                rm_url=rm_url,
+                                workers=workers,
+                                page_size=page_size,
+                                timeout=timeout,
+                                retries=retries,
+                                rate_limit=rate_limit,
+                                disk_cache=disk_cache,
+                                profiler=profiler,
+                                sections=sections,
+                                fuzzy_subitems=conf.get_bool('FUZZY_SUBITEMS'),
+                                incremental=long_running,
+                                user=CurrentUser(**snapshot[0]['user']) if snapshot else None)
+
+                if long_running:
+                    try:
+                        if args.serve is not None:
+                            serve_reports(weekly, args.serve, args.watch)
+                        else:
+                            webbrowser.open(weekly.refresh_week()[0])
+                            weekly.watch(args.watch)
+                    except KeyboardInterrupt:
+                        pass
+                    break
+
+                report_range = weekly.get_report_range()
+                if snapshot is not None:
+                    rpt_names = [weekly.report_snapshot(*snapshot)]
+                elif args.team or args.group:
+                    team = args.team or get_group_user_ids(weekly.redmine, args.group)
+                    rpt_names = weekly.report_team(team, *(report_range or ()))
+                elif report_range:
+                    rpt_names = weekly.report_range(*report_range)
+                else:
+                    rpt_names = [weekly.report_week()]
+
+                if weekly.requests_saved > 0:
+                    print 'Prefetched issues in bulk ({} requests saved).'.format(weekly.requests_saved)
+
+                if len(rpt_names) == 1:
+                    webbrowser.open(rpt_names[0])
+                else:
+                    for rpt_name in rpt_names:
+                        print 'Generated {}'.format(rpt_name)
+                break
+            except rm_exceptions.AuthError:
+                print 'Invalid API KEY. Enter a new value or leave empty to exit.'
+                privconf.put_value('API_KEY', '')
+                api_key = validate_setting(privconf, 'API_KEY')
+                if not api_key:
+                    keep_trying = False
+            except (req_exceptions.ConnectionError, req_exceptions.Timeout):
+                print 'Connection error. Please try again later.'
                 keep_trying = False
-        except req_exceptions.ConnectionError:
-            print 'Connection error. Please try again later.'
-            keep_trying = False
+    finally:
+        if disk_cache is not None:
+            disk_cache.close()
+
+    if args.profile is not None:
+        print profiler.summary()
+        if args.profile:
+            profiler.write_trace(args.profile)